@@ -0,0 +1,100 @@
+'''
+Micro-benchmark: legacy per-parser regex loop vs. compiled dispatcher
+
+Needs a valid config (it is loaded on import):
+    python benchmarks/dispatcher.py [messages] [rounds]
+'''
+
+# Python standard libraries
+import os
+import random
+import re
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local modules
+import main
+
+CHATTER = [
+    "lmao", "good morning everyone", "did anyone see the stream yesterday?",
+    "ok that's actually cursed", "brb food", "`print('hello')` works for me",
+    "can't wait for friday <:pog:123456789012345678>", "||spoiler: he dies||",
+    "no way 😭😭", "I think the update broke something, check the logs",
+    "what time is the meeting tomorrow? 10:00 or 11:00?",
+    "https://example.com/some/article?id=42 worth a read",
+    "https://cdn.discordapp.com/attachments/1/2/image.png",
+]
+
+LINKS = [
+    "https://www.pixiv.net/en/artworks/123456789",
+    "https://www.furaffinity.net/view/54321987/",
+    "https://gelbooru.com/index.php?page=post&s=view&id=9876543",
+    "https://baraag.net/@someone/112233445566778899",
+    "https://x.com/someartist/status/1790000000000000000",
+    "https://fxtwitter.com/someartist/status/1790000000000000001",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://vm.tiktok.com/ZMabcdEFg/",
+    "https://www.deviantart.com/artist/art/Some-Piece-123456",
+    "https://www.reddit.com/r/videos/comments/abc123/some_title/",
+    "https://bsky.app/profile/artist.bsky.social/post/3kabcdefgh",
+    "https://e621.net/pools/12345",
+    "https://inkbunny.net/s/1234567-p2",
+    "<https://x.com/hidden/status/1790000000000000002>",
+]
+
+def corpus(size, link_ratio=0.08, seed=1):
+    '''
+    Mostly chat messages, with a share of messages carrying one or more links
+    '''
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(size):
+        if rng.random() < link_ratio:
+            links = rng.sample(LINKS, rng.randint(1, 3))
+            messages.append(f"{rng.choice(CHATTER)} {' '.join(links)}")
+        else:
+            messages.append(rng.choice(CHATTER))
+    return messages
+
+def legacy_scan(content):
+    '''
+    The pre-dispatcher on_message matching loop
+    '''
+    content = re.sub(main.spoiler_regex, '', content)
+    found = []
+    for parser in main.parsers_new + main.parsers:
+        for match in re.finditer(parser['pattern'], content):
+            found.append((parser['function'], match))
+    return found
+
+def dispatcher_scan(content):
+    return [ (parser['function'], match) for parser, match in main.dispatcher.scan(content) ]
+
+def key(results):
+    return sorted((function.__name__, match.span(), match.groups()) for function, match in results)
+
+def measure(function, messages, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = perf_counter()
+        for content in messages:
+            function(content)
+        best = min(best, perf_counter() - start)
+    return len(messages) / best
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    messages = corpus(size)
+
+    # Both paths must agree on every message
+    for content in messages:
+        assert key(legacy_scan(content)) == key(dispatcher_scan(content)), content
+
+    legacy = measure(legacy_scan, messages, rounds)
+    compiled = measure(dispatcher_scan, messages, rounds)
+    print(f"{size} messages, best of {rounds} rounds")
+    print(f"legacy:     {legacy:12,.0f} msg/s")
+    print(f"dispatcher: {compiled:12,.0f} msg/s ({compiled / legacy:.1f}x)")
@@ -0,0 +1,243 @@
+'''
+Offline replay benchmark of the whole on_message pipeline
+
+Drives `main.on_message` with a message corpus through fake Discord
+channels, with every handler pointed at the local upstream stand-in
+(benchmarks/upstream.py) and the media index kept in memory, then reports
+throughput, per-handler latency and peak RSS.
+
+Needs a valid config (it is loaded on import):
+    python benchmarks/pipeline.py [--messages N] [--latency MS] [--payload KIB] [--corpus FILE]
+
+A corpus file holds one message per line. Reddit links are only replayed
+when ffmpeg is installed (their video and audio are muxed).
+'''
+
+# Python standard libraries
+import argparse
+import asyncio
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local modules
+import database
+import http_client
+import log_mirror
+import main
+import metrics
+import routing
+from config import config
+from upstream import ReplaySession, Upstream
+
+LOGS_CHANNEL = 1
+
+CHATTER = [
+    "lmao", "good morning everyone", "did anyone see the stream yesterday?",
+    "ok that's actually cursed", "brb food", "no way 😭😭",
+    "I think the update broke something, check the logs",
+    "https://example.com/some/article?id=42 worth a read",
+]
+
+# Link templates, `{id}` is drawn from a pool so reposts hit the caches
+LINKS = [
+    "https://www.pixiv.net/en/artworks/{id}",
+    "https://gelbooru.com/index.php?page=post&s=view&id={id}",
+    "https://baraag.net/@someone/{id}",
+    "https://x.com/someartist/status/{id}",
+    "https://vm.tiktok.com/ZM{id}/",
+    "https://e621.net/pools/{id}",
+    "https://inkbunny.net/s/{id}",
+    "https://www.reddit.com/r/videos/comments/r{id}/some_title/",
+]
+
+class FakeChannel:
+    '''
+    Text channel recording what is sent to it
+    '''
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        for file in kwargs.get('files') or ():
+            file.close()
+        return FakeMessage(content or '', self, author=main.bot.user)
+
+class FakeAuthor:
+    # Skips prefix command parsing (bot.process_commands ignores bots)
+    bot = True
+    id = 42
+
+class FakeMessage:
+    def __init__(self, content, channel, author=None):
+        self.content = content
+        self.channel = channel
+        self.author = author or FakeAuthor()
+        self.embeds = []
+        self.attachments = []
+        self.jump_url = f"https://discord.com/channels/0/{channel.id}/0"
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+class MemoryDatabase:
+    '''
+    In-memory replacement of the database functions used by handlers
+    '''
+    def __init__(self):
+        self.media = {}
+        self.tiktoks = {}
+
+    def install(self):
+        for name in ('find_media', 'add_media', 'delete_media', 'delete_media_file', 'find_tiktok', 'add_tiktok', 'delete_tiktok'):
+            setattr(database, name, getattr(self, name))
+
+    async def find_media(self, source, upstream_id, variant=''):
+        return self.media.get((source, upstream_id, variant))
+
+    async def add_media(self, entry):
+        self.media[(entry['source'], entry['upstream_id'], entry['variant'])] = entry
+
+    async def delete_media(self, source, upstream_id, variant=''):
+        self.media.pop((source, upstream_id, variant), None)
+
+    async def delete_media_file(self, filename):
+        self.media = { key: entry for key, entry in self.media.items() if entry['filename'] != filename }
+
+    async def find_tiktok(self, tiktok_id):
+        return self.tiktoks.get(tiktok_id)
+
+    async def add_tiktok(self, tiktok_id, size):
+        self.tiktoks[tiktok_id] = { 'tiktok_id': tiktok_id, 'size': size }
+
+    async def delete_tiktok(self, tiktok_id):
+        self.tiktoks.pop(tiktok_id, None)
+
+def sample_video(path):
+    '''
+    Writes a one second test clip with audio, returns its bytes (None without ffmpeg)
+    '''
+    if not shutil.which('ffmpeg'):
+        return None
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', 'testsrc=duration=1:size=320x240:rate=24',
+        '-f', 'lavfi', '-i', 'sine=duration=1',
+        '-c:v', 'libx264', '-c:a', 'aac', '-shortest', path,
+    ], check=True)
+    with open(path, 'rb') as file:
+        return file.read()
+
+def corpus(size, link_ratio, ids, links, seed=1):
+    '''
+    Mostly chat messages, with a share of messages carrying one or two links
+    '''
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(size):
+        if rng.random() < link_ratio:
+            chosen = rng.sample(links, rng.randint(1, 2))
+            messages.append(' '.join([ rng.choice(CHATTER), *(link.format(id=rng.randint(1, ids)) for link in chosen) ]))
+        else:
+            messages.append(rng.choice(CHATTER))
+    return messages
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+async def replay(messages, concurrency, channels):
+    '''
+    Feeds messages to on_message, `concurrency` at a time, returns their latencies
+    '''
+    latencies = []
+    pending = asyncio.Semaphore(concurrency)
+
+    async def one(index, content):
+        async with pending:
+            start = perf_counter()
+            await main.on_message(FakeMessage(content, channels[index % len(channels)]))
+            latencies.append(perf_counter() - start)
+
+    await asyncio.gather(*(one(index, content) for index, content in enumerate(messages)))
+    return sorted(latencies)
+
+async def benchmark(args):
+    with tempfile.TemporaryDirectory() as media:
+        # Isolated media directory, logs channel and no SauceNao lookups
+        config['media']['path'] = media
+        config['discord']['logs_channel'] = LOGS_CHANNEL
+        config['discord']['sauce_channels'] = []
+        routing.setup(main.dispatcher)
+
+        video = sample_video(f"{media}/sample.mp4")
+        links = LINKS if video else [ link for link in LINKS if 'reddit' not in link ]
+        if args.corpus:
+            with open(args.corpus) as file:
+                messages = [ line.rstrip('\n') for line in file if line.strip() ]
+        else:
+            messages = corpus(args.messages, args.link_ratio, args.ids, links)
+
+        upstream = Upstream(latency=args.latency / 1000, payload_size=args.payload * 1024, video=video)
+        await upstream.start()
+        MemoryDatabase().install()
+        http_client.ClientSession = ReplaySession
+
+        # Exact handler durations next to the histograms
+        durations = {}
+        observe = metrics.observe
+        def record(name, seconds, **labels):
+            if name == 'handler_seconds':
+                durations.setdefault(labels['handler'], []).append(seconds)
+            observe(name, seconds, **labels)
+        metrics.observe = record
+
+        logs = FakeChannel(LOGS_CHANNEL)
+        main.bot.get_channel = lambda channel_id: logs if channel_id == LOGS_CHANNEL else None
+        channels = [ FakeChannel(100 + index) for index in range(args.channels) ]
+
+        http_client.start()
+        start = perf_counter()
+        latencies = await replay(messages, args.concurrency, channels)
+        elapsed = perf_counter() - start
+
+        await log_mirror.close()
+        await http_client.close()
+        await upstream.close()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    served = upstream.served()
+    print(f"{len(messages)} messages, {args.concurrency} at a time, upstream latency {args.latency} ms, files {args.payload} KiB")
+    print(f"throughput: {len(messages) / elapsed:10,.1f} msg/s ({elapsed:.2f} s)")
+    print(f"on_message: p50 {percentile(latencies, 0.5) * 1000:8.1f} ms, p99 {percentile(latencies, 0.99) * 1000:8.1f} ms")
+    print(f"upstream:   {served['requests']} requests, {served['bytes'] / 2**20:.1f} MiB served")
+    print(f"replies:    {sum(channel.sent for channel in channels)} (+{logs.sent} to logs)")
+    print(f"peak RSS:   {peak_rss:.1f} MiB")
+    print(f"{'handler':<14}{'runs':>7}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for handler, samples in sorted(durations.items()):
+        samples.sort()
+        errors = metrics.counters[('handler_errors_total', (('handler', handler),))]
+        print(f"{handler:<14}{len(samples):>7}{percentile(samples, 0.5) * 1000:>10.1f}{percentile(samples, 0.99) * 1000:>10.1f}{errors:>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000, help='generated corpus size')
+    parser.add_argument('--corpus', help='file with one message per line instead of a generated corpus')
+    parser.add_argument('--link-ratio', type=float, default=0.2, help='share of generated messages with links')
+    parser.add_argument('--ids', type=int, default=200, help='distinct ids per link type (lower means more cache hits)')
+    parser.add_argument('--concurrency', type=int, default=32, help='messages processed at once')
+    parser.add_argument('--channels', type=int, default=8, help='fake channels messages are spread over')
+    parser.add_argument('--latency', type=float, default=50, help='upstream response latency in ms')
+    parser.add_argument('--payload', type=int, default=256, help='size of downloaded files in KiB')
+    asyncio.run(benchmark(parser.parse_args()))
@@ -0,0 +1,130 @@
+'''
+Benchmark: legacy task-per-reminder scheduling vs. the windowed heap scheduler
+
+Needs a valid config (it is loaded on import):
+    python benchmarks/reminders.py [reminders]
+'''
+
+# Python standard libraries
+import asyncio
+import bisect
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local modules
+from cogs.reminders import ReminderScheduler
+
+class Store:
+    '''
+    In-memory stand-in for the reminders collection, sorted by target
+    '''
+    def __init__(self, reminders):
+        self.reminders = sorted(reminders, key=lambda reminder: reminder['target'])
+        self.targets = [ reminder['target'] for reminder in self.reminders ]
+        self.deleted = set()
+        self.first = 0 # reminders before this index are all deleted
+
+    async def due(self, until, after=None, limit=0):
+        while self.first < len(self.reminders) and self.reminders[self.first]['_id'] in self.deleted:
+            self.first += 1
+        start = self.first if after is None else max(self.first, bisect.bisect_left(self.targets, after))
+        due = []
+        for reminder in self.reminders[start:bisect.bisect_right(self.targets, until)]:
+            if reminder['_id'] not in self.deleted:
+                due.append(reminder)
+                if len(due) == limit:
+                    break
+        return due
+
+    async def delete(self, reminder_id):
+        self.deleted.add(reminder_id)
+
+    async def pending(self, after):
+        return self.reminders[bisect.bisect_right(self.targets, after):]
+
+def generate(size, spread, seed=1):
+    rng = random.Random(seed)
+    now = datetime.now()
+    return [
+        { '_id': i, 'user_id': i % 500, 'channel_id': 1, 'message': 'stretch', 'target': now + timedelta(seconds=rng.uniform(0.5, spread)) }
+        for i in range(size)
+    ]
+
+async def legacy(store, fire, wait):
+    '''
+    The pre-scheduler on_ready: one sleeping task per pending reminder
+    '''
+    async def task(reminder):
+        delay = (reminder['target'] - datetime.now()).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await fire(reminder)
+
+    tasks = [ asyncio.create_task(task(reminder)) for reminder in await store.pending(datetime.now()) ]
+    await wait()
+    for running in tasks:
+        running.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def heap(store, fire, wait):
+    scheduler = ReminderScheduler(store.due, fire)
+    scheduler.start()
+    await wait()
+    scheduler.stop()
+    await asyncio.gather(scheduler.task, return_exceptions=True)
+
+async def scenario(strategy, reminders, until_fired):
+    '''
+    Runs strategy until `until_fired` reminders fired (or for 1s if None),
+    returns (seconds, peak traced bytes, lateness of fired reminders)
+    '''
+    store = Store(reminders)
+    fired = []
+    done = asyncio.Event()
+
+    async def fire(reminder):
+        fired.append((datetime.now() - reminder['target']).total_seconds())
+        await store.delete(reminder['_id'])
+        if until_fired and len(fired) >= until_fired:
+            done.set()
+
+    async def wait():
+        if until_fired:
+            await done.wait()
+        else:
+            await asyncio.sleep(1)
+
+    tracemalloc.start()
+    start = perf_counter()
+    await strategy(store, fire, wait)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fired.sort()
+    return elapsed, peak, fired
+
+def report(name, result):
+    elapsed, peak, fired = result
+    lateness = f"p50 {fired[len(fired) // 2] * 1000:6.1f} ms, p99 {fired[int(len(fired) * 0.99)] * 1000:6.1f} ms late" if fired else 'none fired'
+    print(f"  {name:7} {elapsed:6.2f} s, peak {peak / 2**20:7.1f} MiB, {len(fired):>7} fired ({lateness})")
+
+async def benchmark(size):
+    # Mostly far-future reminders: memory held while waiting
+    reminders = generate(size, spread=30 * 86400)
+    print(f"{size} reminders over 30 days, held for 1s")
+    report('legacy', await scenario(legacy, reminders, None))
+    report('heap', await scenario(heap, reminders, None))
+
+    # Everything due within 10 seconds: firing throughput and lateness
+    print(f"{size} reminders due within 10s")
+    report('legacy', await scenario(legacy, generate(size, spread=10), size))
+    report('heap', await scenario(heap, generate(size, spread=10), size))
+
+if __name__ == '__main__':
+    asyncio.run(benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
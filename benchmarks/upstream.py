@@ -0,0 +1,160 @@
+'''
+Local stand-in for the upstream sites used by the handlers
+
+Requests are routed by the original host, sent as the first path segment
+(`http://127.0.0.1:<port>/<host>/<path>`, see `ReplaySession`), and answered
+with canned responses after a configurable latency.
+'''
+
+# Python standard libraries
+import asyncio
+import random
+
+# Third-party libraries
+from aiohttp import ClientSession, web
+from yarl import URL
+
+class ReplaySession(ClientSession):
+    '''
+    ClientSession sending every request to the stand-in server instead
+    '''
+    base = None # URL of the stand-in server, set by `Upstream.start`
+
+    async def _request(self, method, str_or_url, **kwargs):
+        url = URL(str_or_url)
+        if self.base is not None and url.host != self.base.host:
+            url = self.base.with_path(f"/{url.host}{url.raw_path}", encoded=True).with_query(url.raw_query_string)
+        return await super()._request(method, url, **kwargs)
+
+class Upstream:
+    '''
+    Canned fxtwitter, twitter oembed, phixiv, booru, mastodon, e621,
+    inkbunny, reddit and tiktok responses
+    '''
+    def __init__(self, latency=0.05, jitter=0.5, payload_size=256 * 1024, video=None, seed=1):
+        self.latency = latency # seconds before each response
+        self.jitter = jitter # latency varies by up to this share
+        self.payload = random.Random(seed).randbytes(payload_size) # body of every downloaded file
+        self.video = video # valid mp4 served for reddit, which is muxed by ffmpeg
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.sent = 0
+        self.runner = None
+        self.base = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/{host}/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = ReplaySession.base = URL(f"http://127.0.0.1:{port}")
+
+    async def close(self):
+        ReplaySession.base = None
+        await self.runner.cleanup()
+
+    def local(self, host, path):
+        '''
+        Stand-in URL of a file on host (redirects and download links)
+        '''
+        return str(self.base.with_path(f"/{host}{path}"))
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+        host, path = request.match_info['host'], '/' + request.match_info['path']
+        response = self.route(host, path, request.query)
+        if response.body is not None:
+            self.sent += len(response.body)
+        return response
+
+    def file(self, body=None):
+        return web.Response(body=self.payload if body is None else body, content_type='application/octet-stream')
+
+    def route(self, host, path, query):
+        parts = path.strip('/').split('/')
+
+        # fxtwitter: a photo and a video per tweet, twitter's own embed always fails
+        if host == 'api.fxtwitter.com':
+            tweet_id = parts[-1]
+            return web.json_response({ 'code': 200, 'tweet': {
+                'author': { 'screen_name': 'someartist' },
+                'media': {
+                    'photos': [ { 'url': f"https://pbs.twimg.com/media/{tweet_id}.jpg" } ],
+                    'videos': [ { 'type': 'video', 'url': f"https://video.twimg.com/{tweet_id}.mp4" } ],
+                },
+            } })
+        if host == 'publish.twitter.com':
+            return web.json_response({ 'error': 'Not found' }, status=404)
+
+        if host == 'www.phixiv.net':
+            illust_id = query.get('id')
+            return web.json_response({
+                'title': f"Artwork {illust_id}",
+                'author_name': 'someartist',
+                'image_proxy_urls': [ f"https://www.phixiv.net/i/{illust_id}_p{page}.jpg" for page in range(3) ],
+            })
+
+        if host in ('gelbooru.com', 'rule34.xxx'):
+            return web.Response(text=f'<posts count="1"><post file_url="https://img.{host}/images/{query.get("id")}.png"/></posts>', content_type='text/xml')
+
+        # Mastodon: embeds are broken, statuses carry two images
+        if host in ('baraag.net', 'pawoo.net'):
+            if parts[:2] == ['api', 'oembed']:
+                return web.json_response({ 'error': 'Record not found' }, status=404)
+            return web.json_response({
+                'account': { 'display_name': 'someone' },
+                'media_attachments': [ { 'url': f"https://{host}/media/{parts[-1]}-{index}.png" } for index in range(2) ],
+            })
+
+        # e621: pools of 12 posts, files on static1
+        if host == 'e621.net':
+            if parts[0] == 'pools':
+                pool_id = int(parts[1].split('.')[0])
+                return web.json_response({ 'post_ids': [ pool_id * 100 + index for index in range(12) ] })
+            if parts[0] == 'posts.json':
+                post_ids = [ int(post_id) for post_id in query['tags'].removeprefix('id:').split(',') ]
+                return web.json_response({ 'posts': [
+                    { 'id': post_id, 'file': { 'md5': f"{post_id:032x}", 'ext': 'png', 'url': self.local('static1.e621.net', f"/data/{post_id}.png") } }
+                    for post_id in post_ids
+                ] })
+        if host == 'static1.e621.net':
+            return self.file()
+
+        # Inkbunny: submissions with 3 pages
+        if host == 'inkbunny.net':
+            if parts[0] == 'api_login.php':
+                return web.json_response({ 'sid': 'replay-session' })
+            if parts[0] == 'api_submissions.php':
+                submission_id = query['submission_ids']
+                return web.json_response({ 'submissions': [ { 'files': [
+                    { 'file_name': f"{submission_id}_p{page}.png", 'file_url_full': self.local('tx.ib.metapix.net', f"/files/full/{submission_id}_p{page}.png") }
+                    for page in range(3)
+                ] } ] })
+        if host == 'tx.ib.metapix.net':
+            return self.file()
+
+        # Reddit: post listing pointing to DASH video and audio tracks
+        if host == 'www.reddit.com':
+            post_id = parts[parts.index('comments') + 1]
+            return web.json_response([ { 'data': { 'children': [ { 'data': {
+                'subreddit_id': 't5_replay', 'id': post_id,
+                'secure_media': { 'reddit_video': { 'fallback_url': self.local('v.redd.it', f"/{post_id}/DASH_720.mp4") } },
+            } } ] } } ])
+        if host == 'v.redd.it':
+            return self.file(self.video)
+
+        # Tiktok: short links redirect to the video page, kktiktok serves the video
+        if host == 'vm.tiktok.com':
+            raise web.HTTPFound(self.local('www.tiktok.com', f"/@someone/video/{int.from_bytes(parts[0].encode(), 'big') % 10**18}"))
+        if host == 'www.kktiktok.com':
+            return self.file()
+
+        return web.Response(status=404, text=f"no canned response for {host}{path}")
+
+    def served(self):
+        return { 'requests': self.requests, 'bytes': self.sent }
@@ -0,0 +1,125 @@
+'''
+In-memory caches and coalescing for upstream lookups
+'''
+
+# Python standard libraries
+import asyncio
+from collections import Counter, OrderedDict
+from time import monotonic
+
+# Returned by `get` when a key is missing or expired
+MISSING = object()
+
+class TTLCache:
+    '''
+    Bounded mapping with per-entry expiry and least recently used eviction
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        expires, value = entry
+        if expires <= monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return MISSING
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+# Upstream metadata lifetimes in seconds, by source
+METADATA_TTLS = {
+    'fxtwitter': 300,
+    'twitter_oembed': 3600,
+    'phixiv': 3600,
+    'booru': 3600,
+    'mastodon': 600,
+    'deviantart': 3600,
+    'tiktok_link': 3600,
+}
+
+# Lifetime of negative results (no media, embed already valid, forbidden, ...)
+NEGATIVE_TTL = 120
+
+metadata = TTLCache(maxsize=4096, ttl=600)
+metadata_hits = Counter()
+metadata_misses = Counter()
+
+def lookup(source, key):
+    '''
+    Returns cached metadata for (source, key) or MISSING
+    '''
+    value = metadata.get((source, key))
+    if value is MISSING:
+        metadata_misses[source] += 1
+    else:
+        metadata_hits[source] += 1
+    return value
+
+def store(source, key, value):
+    '''
+    Caches metadata for (source, key), falsy values count as negative results
+    '''
+    metadata.set((source, key), value, ttl=METADATA_TTLS.get(source) if value else NEGATIVE_TTL)
+
+async def memoize(source, key, fetch):
+    '''
+    Returns cached metadata for (source, key), awaiting `fetch()` on a miss
+    '''
+    value = lookup(source, key)
+    if value is MISSING:
+        value = await single_flight((source, key), fetch)
+        store(source, key, value)
+    return value
+
+def stats():
+    '''
+    Hit and miss counters for each metadata source
+    '''
+    return {
+        source: { 'hits': metadata_hits[source], 'misses': metadata_misses[source] }
+        for source in sorted(set(metadata_hits) | set(metadata_misses))
+    }
+
+# Tasks of in-flight work, by key
+inflight = {}
+
+def _finished(key, task):
+    if inflight.get(key) is task:
+        del inflight[key]
+
+    # Mark the exception retrieved even if every caller was cancelled
+    if not task.cancelled():
+        task.exception()
+
+async def single_flight(key, work):
+    '''
+    Runs `work()` once for all concurrent callers with the same key and
+    returns its result (or raises its exception) to each of them
+    '''
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(work())
+        task.add_done_callback(lambda task: _finished(key, task))
+
+    # A cancelled caller must not cancel the work shared with the others
+    return await asyncio.shield(task)
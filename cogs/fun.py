@@ -1,7 +1,7 @@
 import discord
 from discord.ext import bridge, commands
 from config import config
-from pymongo import MongoClient
+import tiktok_pool
 
 class Fun(commands.Cog):
     def __init__(self, bot):
@@ -10,9 +10,11 @@ class Fun(commands.Cog):
     @bridge.bridge_command(name='tiktok')
     async def _tiktok(self, ctx):
         '''Posts a random tiktok from sourcebot's collection.'''
-        client = MongoClient(config['mongo']['uri'])
-        tiktok = client['sourcebot']['tiktok_db'].aggregate([{"$sample": {"size": 1}}]).next()
-        await ctx.respond(f"{config['media']['url']}/tiktok-{tiktok['tiktok_id']}.mp4")
+        tiktok_id = tiktok_pool.pick(ctx.channel.id)
+        if tiktok_id is None:
+            await ctx.respond("No tiktoks collected yet.")
+            return
+        await ctx.respond(f"{config['media']['url']}/tiktok-{tiktok_id}.mp4")
 
     @bridge.bridge_command(name='friday')
     async def _friday(self, ctx):
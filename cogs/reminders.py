@@ -1,45 +1,142 @@
 import asyncio
+import heapq
+import itertools
+import traceback
 import discord
-from datetime import datetime
+from datetime import datetime, timedelta
 from discord.ext import bridge, commands
-from config import config
-from pymongo import MongoClient
+import database
+
+class ReminderScheduler:
+    '''
+    Single task firing reminders from a min-heap
+
+    Only reminders due within `window` seconds (including overdue ones) are
+    held in memory, at most `batch` per load; the window is reloaded as time
+    passes, so memory stays flat regardless of how many reminders are pending.
+    A failed load is retried after `retry` seconds.
+    '''
+    def __init__(self, load, fire, window=3600, batch=10000, retry=30):
+        self.load = load # async (until, after, limit) -> reminders with after <= target <= until, by target
+        self.fire = fire # async (reminder) -> None
+        self.window = timedelta(seconds=window)
+        self.batch = batch
+        self.retry = timedelta(seconds=retry)
+        self.heap = []
+        self.scheduled = set()
+        self.sequence = itertools.count()
+        self.horizon = None
+        self.loading_until = None
+        self.next_load = None
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.firing = set()
+
+    def start(self):
+        '''
+        Starts the scheduler task, no-op if it is already running
+        '''
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for task in self.firing:
+            task.cancel()
+
+    def add(self, reminder):
+        '''
+        Schedules a newly created reminder
+        '''
+        # Reminders beyond the loaded window are picked up by a later load; a
+        # load in progress may have queried before this one was stored
+        limits = [ limit for limit in (self.horizon, self.loading_until) if limit is not None ]
+        if limits and reminder['target'] <= max(limits):
+            self._push(reminder)
+        self.wakeup.set()
+
+    def _push(self, reminder):
+        if reminder['_id'] in self.scheduled:
+            return
+        self.scheduled.add(reminder['_id'])
+        heapq.heappush(self.heap, (reminder['target'], next(self.sequence), reminder))
 
-client = MongoClient(config['mongo']['uri'])
-reminders_col = client['sourcebot']['reminders']
+    async def _load(self):
+        now = datetime.now()
+        until = now + self.window
+        # Only the first load looks into the past, later ones continue from the horizon
+        self.loading_until = until
+        try:
+            reminders = await self.load(until, self.horizon, self.batch)
+        finally:
+            self.loading_until = None
+        for reminder in reminders:
+            self._push(reminder)
+
+        if len(reminders) < self.batch:
+            self.horizon = until
+            self.next_load = now + self.window / 2
+        else:
+            # Truncated load: everything up to the last loaded target is in the heap
+            self.horizon = reminders[-1]['target']
+            self.next_load = self.horizon
+
+    async def _fire(self, reminder):
+        try:
+            await self.fire(reminder)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.scheduled.discard(reminder['_id'])
+
+    async def run(self):
+        while True:
+            now = datetime.now()
+            if self.next_load is None or now >= self.next_load:
+                try:
+                    await self._load()
+                except Exception:
+                    print(f"[reminders] Failed to load reminders, retrying in {self.retry.total_seconds():.0f}s:")
+                    traceback.print_exc()
+                    self.next_load = now + self.retry
+
+            # Fire everything that is due (overdue reminders included), a
+            # reminder stays in `scheduled` until it was sent and deleted
+            while self.heap and self.heap[0][0] <= now:
+                task = asyncio.create_task(self._fire(heapq.heappop(self.heap)[2]))
+                self.firing.add(task)
+                task.add_done_callback(self.firing.discard)
+
+            # Sleep until the next deadline, the next load or a new reminder
+            deadline = min(self.heap[0][0], self.next_load) if self.heap else self.next_load
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max((deadline - datetime.now()).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
 
 class Reminders(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.scheduler = ReminderScheduler(database.due_reminders, self._fire)
 
-    def _schedule(self, reminder):
-        asyncio.create_task(self._fire(reminder))
+    def cog_unload(self):
+        self.scheduler.stop()
 
     async def _fire(self, reminder):
-        now = datetime.now()
-        delay = (reminder['target'] - now).total_seconds()
-
-        if delay > 0:
-            await asyncio.sleep(delay)
-
+        # A reminder that could not be sent stays stored and is fired again
+        # (as overdue) on the next startup
         user = self.bot.get_user(reminder['user_id'])
-        if not user:
-            return
-
-        channel = self.bot.get_channel(reminder['channel_id']) or await user.create_dm()
-        await channel.send(f"⏰ {user.mention} Reminder: **{reminder['message']}**")
-
-        reminders_col.delete_one({'_id': reminder['_id']})
+        if user:
+            channel = self.bot.get_channel(reminder['channel_id']) or await user.create_dm()
+            await channel.send(f"⏰ {user.mention} Reminder: **{reminder['message']}**")
+        await database.delete_reminder(reminder['_id'])
 
     @commands.Cog.listener()
     async def on_ready(self):
-        pending = reminders_col.find({'target': {'$gt': datetime.now()}})
-        count = 0
-        for reminder in pending:
-            self._schedule(reminder)
-            count += 1
-        if count:
-            print(f"[reminders] Rescheduled {count} pending reminder(s).")
+        # on_ready runs again after reconnects, the scheduler is only started once
+        self.scheduler.start()
 
     @bridge.bridge_command(name='remind')
     async def _remind(self, ctx, *, args: str):
@@ -86,19 +183,15 @@ class Reminders(commands.Cog):
             'channel_id': ctx.channel.id,
             'user_id': ctx.author.id,
         }
-        result = reminders_col.insert_one(reminder)
-        reminder['_id'] = result.inserted_id
+        reminder['_id'] = await database.add_reminder(reminder)
 
-        self._schedule(reminder)
+        self.scheduler.add(reminder)
         await ctx.respond(f"✅ I'll remind you at **{target.strftime('%Y-%m-%d %H:%M')}**: *{message}*")
 
     @bridge.bridge_command(name='reminders')
     async def _reminders(self, ctx):
         '''List your pending reminders.'''
-        pending = list(reminders_col.find({
-            'user_id': ctx.author.id,
-            'target': {'$gt': datetime.now()}
-        }).sort('target', 1))
+        pending = await database.pending_reminders(datetime.now(), user_id=ctx.author.id)
 
         if not pending:
             await ctx.respond("You have no pending reminders.")
@@ -1,13 +1,35 @@
 # cogs/roles.py
+import asyncio
 import discord
 from discord.ext import bridge, commands
 from discord.ext.commands import has_permissions
-from pymongo import MongoClient
 from config import config
+import database
 
 class Roles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.roles = None # guild id -> emoji -> role id
+        self.roles_lock = asyncio.Lock()
+
+    async def role_index(self):
+        '''Returns the reaction role mapping, loaded from mongodb on first use'''
+        async with self.roles_lock:
+            if self.roles is None:
+                roles = {}
+                for entry in await database.all_roles():
+                    roles.setdefault(entry['guild'], {}).setdefault(entry['emoji'], entry['role'])
+                self.roles = roles
+        return self.roles
+
+    async def is_own_message(self, channel, payload):
+        '''Checks if reacted message was sent by the bot, without fetching it if possible'''
+        author_id = payload.data.get('message_author_id')
+        if author_id is not None:
+            return int(author_id) == self.bot.user.id
+
+        message = self.bot.get_message(payload.message_id) or await channel.fetch_message(payload.message_id)
+        return message.author == self.bot.user
 
     async def handle_reaction(self, payload):
         '''Handler for reactions (removing bot's messages & roles in guilds)'''
@@ -17,37 +39,30 @@ class Roles(commands.Cog):
         if channel is None:
             return
 
-        message = await channel.fetch_message(payload.message_id)
         guild = self.bot.get_guild(payload.guild_id)
         if guild is None:
             return
 
-        member = guild.get_member(payload.user_id)
-
         # Remove bot's message on "❌" reaction
-        if payload.event_type == 'REACTION_ADD' and message.author == self.bot.user and emoji == '❌':
-            await message.delete()
+        if payload.event_type == 'REACTION_ADD' and emoji == '❌' and await self.is_own_message(channel, payload):
+            await channel.get_partial_message(payload.message_id).delete()
             return
 
         # Check if reaction was in the right channel
         if channel.name != config['discord']['role_channel']:
             return
 
-        # Search for role in mongodb
-        client = MongoClient(config['mongo']['uri'])
-        result = client['sourcebot']['roles'].find_one({
-            'guild': payload.guild_id,
-            'emoji': emoji
-        })
+        member = guild.get_member(payload.user_id)
+        role_id = (await self.role_index()).get(payload.guild_id, {}).get(emoji)
 
-        if result:
-            role = guild.get_role(result['role'])
+        if role_id:
+            role = guild.get_role(role_id)
             if payload.event_type == 'REACTION_ADD':
                 await member.add_roles(role, reason='emoji_role_add')
             if payload.event_type == 'REACTION_REMOVE':
                 await member.remove_roles(role, reason='emoji_role_remove')
         else:
-            await message.remove_reaction(payload.emoji, member)
+            await channel.get_partial_message(payload.message_id).remove_reaction(payload.emoji, member)
 
     # listners
     @commands.Cog.listener()
@@ -64,8 +79,7 @@ class Roles(commands.Cog):
     async def _list(self, ctx):
         '''Returns current list of roles configured for sourcebot.'''
         embed = discord.Embed(title="Current settings", colour=discord.Colour(0x8ba089))
-        client = MongoClient(config['mongo']['uri'])
-        for role in client['sourcebot']['roles'].find({'guild': ctx.guild.id}):
+        for role in await database.list_roles(ctx.guild.id):
             embed.add_field(name=role['emoji'], value=f"<@&{role['role']}>")
         await ctx.respond(embed=embed)
 
@@ -73,23 +87,16 @@ class Roles(commands.Cog):
     @has_permissions(administrator=True)
     async def _add(self, ctx, emoji: str, *, role: discord.Role):
         '''Adds a new role reaction to sourcebot.'''
-        client = MongoClient(config['mongo']['uri'])
-        client['sourcebot']['roles'].insert_one({
-            'guild': ctx.guild.id,
-            'emoji': emoji,
-            'role': role.id
-        })
+        await database.add_role(ctx.guild.id, emoji, role.id)
+        (await self.role_index()).setdefault(ctx.guild.id, {})[emoji] = role.id
         await ctx.respond(f"{self.bot.user.name} added: {emoji} -> {role}")
 
     @bridge.bridge_command(name='remove')
     @has_permissions(administrator=True)
     async def _remove(self, ctx, emoji: str):
         '''Removes a role reaction from sourcebot list.'''
-        client = MongoClient(config['mongo']['uri'])
-        client['sourcebot']['roles'].delete_one({
-            'guild': ctx.guild.id,
-            'emoji': emoji
-        })
+        await database.remove_role(ctx.guild.id, emoji)
+        (await self.role_index()).get(ctx.guild.id, {}).pop(emoji, None)
         await ctx.respond(f"{self.bot.user.name} deleted: {emoji}")
 
 def setup(bot):
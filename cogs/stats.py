@@ -0,0 +1,43 @@
+# cogs/stats.py
+import discord
+from discord.ext import bridge, commands
+from discord.ext.commands import has_permissions
+import metrics
+
+def _duration(seconds):
+    if seconds == float('inf'):
+        return '>300s'
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:g}s"
+
+class Stats(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @bridge.bridge_command(name='stats')
+    @has_permissions(administrator=True)
+    async def _stats(self, ctx):
+        '''Shows sourcebot performance statistics since startup.'''
+        summary = metrics.summary()
+        embed = discord.Embed(title="Performance", colour=discord.Colour(0x8ba089))
+
+        handlers = sorted(summary['handlers'].items(), key=lambda item: -item[1]['runs'])
+        embed.add_field(name="Handlers (runs, p50/p99 ≤, errors)", inline=False, value='\n'.join(
+            f"`{name}` {data['runs']}, {_duration(data['p50'])}/{_duration(data['p99'])}, {data['errors']}"
+            for name, data in handlers
+        ) or "No handler runs yet.")
+
+        embed.add_field(name="Components (count, p50/p99 ≤, errors)", inline=False, value='\n'.join(
+            f"`{name}` {histogram.count}, {_duration(histogram.quantile(0.5))}/{_duration(histogram.quantile(0.99))}, {summary['errors'].get(name.split('_')[0], 0)}"
+            for name, histogram in summary['components'].items() if histogram.count
+        ) or "Nothing recorded yet.")
+
+        embed.add_field(name="Metadata cache (hits/misses)", inline=False, value='\n'.join(
+            f"`{source}` {data['hits']}/{data['misses']}" for source, data in summary['cache'].items()
+        ) or "Empty.")
+
+        embed.add_field(name="Downloaded", value=f"{summary['received_bytes'] / 2**20:.1f} MiB")
+        embed.add_field(name="Media directory", value=f"{summary['media_files']} files, {summary['media_bytes'] / 2**30:.2f} GiB")
+        await ctx.respond(embed=embed)
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
@@ -1,11 +1,86 @@
 '''
 Sourcebot configuration
 '''
+# Python standard libraries
+import asyncio
+import os
+import traceback
+
 # Third-party libraries
 import yaml
 
-MAIN_CONFIG = "code/config/main.yml"
+# Config file next to this module, unless SOURCEBOT_CONFIG points elsewhere
+MAIN_CONFIG = os.environ.get('SOURCEBOT_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'main.yml')
+
+# Seconds between checks for config file changes
+WATCH_INTERVAL = 5
+
+def _load():
+    with open(MAIN_CONFIG) as file:
+        loaded = yaml.safe_load(file)
+    if not isinstance(loaded, dict):
+        raise ValueError(f"{MAIN_CONFIG} does not hold a mapping")
+    return loaded
 
 # Load config files
-with open(MAIN_CONFIG) as file:
-    config = yaml.safe_load(file)
+config = _load()
+
+# Called with every new config before it is applied, each returns a callable
+# applying its own derived state (or raises to reject the new config)
+listeners = []
+
+_mtime = os.stat(MAIN_CONFIG).st_mtime_ns
+_watcher = None
+
+def reload():
+    '''
+    Re-reads the config file into `config` in place, returns True if it changed
+
+    An unreadable file, or one rejected by a listener, leaves the current
+    config and all derived state untouched.
+    '''
+    try:
+        loaded = _load()
+        if loaded == config:
+            return False
+        apply = [ listener(loaded) for listener in listeners ]
+    except Exception:
+        print(f"[config] Keeping current config, {MAIN_CONFIG} was rejected:")
+        traceback.print_exc()
+        return False
+
+    # Both steps are synchronous, no coroutine sees a half-applied config
+    config.clear()
+    config.update(loaded)
+    for function in apply:
+        function()
+    return True
+
+async def watch():
+    global _mtime
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        try:
+            mtime = os.stat(MAIN_CONFIG).st_mtime_ns
+        except OSError:
+            continue
+
+        if mtime != _mtime:
+            _mtime = mtime
+            if reload():
+                print(f"[config] Reloaded {MAIN_CONFIG}")
+
+def start():
+    '''
+    Start watching the config file for changes (called once on bot startup)
+    '''
+    global _watcher
+    if _watcher is None:
+        _watcher = asyncio.create_task(watch())
+
+async def close():
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        await asyncio.gather(_watcher, return_exceptions=True)
+        _watcher = None
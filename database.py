@@ -0,0 +1,121 @@
+'''
+Async MongoDB access layer for sourcebot
+'''
+
+# Python standard libraries
+from datetime import datetime
+
+# Third-party libraries
+from bson import ObjectId
+from pymongo import ASCENDING, AsyncMongoClient, UpdateOne
+
+# Local modules
+import metrics
+from config import config
+
+_client = None
+
+def db():
+    '''
+    Returns sourcebot database on the shared, pooled client
+    '''
+    global _client
+    if _client is None:
+        _client = AsyncMongoClient(config['mongo']['uri'], event_listeners=[metrics.MongoListener()])
+    return _client['sourcebot']
+
+async def close():
+    '''
+    Close the shared client (called on shutdown)
+    '''
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+# Roles
+async def list_roles(guild_id: int) -> list[dict]:
+    return await db()['roles'].find({ 'guild': guild_id }).to_list()
+
+async def all_roles() -> list[dict]:
+    return await db()['roles'].find().to_list()
+
+async def add_role(guild_id: int, emoji: str, role_id: int) -> None:
+    await db()['roles'].update_one({ 'guild': guild_id, 'emoji': emoji }, { '$set': { 'role': role_id } }, upsert=True)
+
+async def remove_role(guild_id: int, emoji: str) -> None:
+    await db()['roles'].delete_many({ 'guild': guild_id, 'emoji': emoji })
+
+# Reminders
+async def add_reminder(reminder: dict) -> ObjectId:
+    result = await db()['reminders'].insert_one(reminder)
+    return result.inserted_id
+
+async def delete_reminder(reminder_id: ObjectId) -> None:
+    await db()['reminders'].delete_one({ '_id': reminder_id })
+
+async def due_reminders(until: datetime, after: datetime | None = None, limit: int = 0) -> list[dict]:
+    target = { '$lte': until } if after is None else { '$gte': after, '$lte': until }
+    return await db()['reminders'].find({ 'target': target }).sort('target', 1).limit(limit).to_list()
+
+async def pending_reminders(after: datetime, user_id: int | None = None) -> list[dict]:
+    query = { 'target': { '$gt': after } }
+    if user_id is not None:
+        query['user_id'] = user_id
+    return await db()['reminders'].find(query).sort('target', 1).to_list()
+
+# Tiktok cache
+async def delete_tiktok(tiktok_id: int) -> None:
+    await db()['tiktok_db'].delete_one({ 'tiktok_id': tiktok_id })
+
+async def find_tiktok(tiktok_id: int) -> dict | None:
+    return await db()['tiktok_db'].find_one({ 'tiktok_id': tiktok_id })
+
+async def add_tiktok(tiktok_id: int, size: int) -> None:
+    await db()['tiktok_db'].insert_one({ 'tiktok_id': tiktok_id, 'size': size })
+
+async def tiktok_ids() -> list[int]:
+    return [ tiktok['tiktok_id'] async for tiktok in db()['tiktok_db'].find({}, { '_id': 0, 'tiktok_id': 1 }) ]
+
+# Media index
+async def find_media(source: str, upstream_id: str, variant: str = '') -> dict | None:
+    return await db()['media'].find_one({ 'source': source, 'upstream_id': upstream_id, 'variant': variant })
+
+async def add_media(entry: dict) -> None:
+    key = { 'source': entry['source'], 'upstream_id': entry['upstream_id'], 'variant': entry['variant'] }
+
+    # A file belongs to one entry only, drop entries whose file was overwritten
+    await db()['media'].delete_many({ 'filename': entry['filename'], '$nor': [ key ] })
+    await db()['media'].replace_one(key, entry, upsert=True)
+
+async def delete_media(source: str, upstream_id: str, variant: str = '') -> None:
+    await db()['media'].delete_one({ 'source': source, 'upstream_id': upstream_id, 'variant': variant })
+
+async def delete_media_file(filename: str) -> None:
+    await db()['media'].delete_many({ 'filename': filename })
+
+async def migrate_tiktok_media() -> int:
+    '''
+    Creates media index and copies tiktok_db entries missing from it, returns count added
+    '''
+    await db()['media'].create_index(
+        [ ('source', ASCENDING), ('upstream_id', ASCENDING), ('variant', ASCENDING) ], unique=True
+    )
+
+    requests = []
+    async for tiktok in db()['tiktok_db'].find():
+        requests.append(UpdateOne(
+            { 'source': 'tiktok', 'upstream_id': str(tiktok['tiktok_id']), 'variant': '' },
+            { '$setOnInsert': {
+                'filename': f"tiktok-{tiktok['tiktok_id']}.mp4",
+                'size': tiktok.get('size'),
+                'sha256': None,
+                'created': tiktok['_id'].generation_time.replace(tzinfo=None),
+            } },
+            upsert=True
+        ))
+
+    if not requests:
+        return 0
+    result = await db()['media'].bulk_write(requests, ordered=False)
+    return result.upserted_count
@@ -0,0 +1,62 @@
+'''
+Single-pass URL dispatcher for sourcebot parsers
+'''
+
+# Characters required for any spoiler tag to be present
+SPOILER_MARKERS = ('||', '<', '`')
+
+class Dispatcher:
+    '''
+    Matches message content against a parser table
+
+    Each parser may list `hints`: literal substrings of which at least one
+    must be present for its pattern to match at all. Parsers whose hints
+    are all absent are skipped without running their regular expression.
+    '''
+    def __init__(self, parsers, spoiler_pattern=None):
+        self.parsers = list(parsers)
+        self.spoiler_pattern = spoiler_pattern
+
+        # Host-keyed lookup: hint -> indices of parsers using it
+        self.always = []
+        self.by_hint = {}
+        for index, parser in enumerate(self.parsers):
+            hints = parser.get('hints')
+            if not hints:
+                self.always.append(index)
+                continue
+            for hint in hints:
+                self.by_hint.setdefault(hint, []).append(index)
+
+    def strip_spoilers(self, content):
+        '''
+        Removes text in spoiler tags, skipping the regex when no tag can exist
+        '''
+        if self.spoiler_pattern is None or not any(marker in content for marker in SPOILER_MARKERS):
+            return content
+        return self.spoiler_pattern.sub('', content)
+
+    def candidates(self, content):
+        '''
+        Returns indices of parsers which may match content, in table order
+        '''
+        selected = set(self.always)
+        for hint, indices in self.by_hint.items():
+            if hint in content:
+                selected.update(indices)
+        return sorted(selected)
+
+    def scan(self, content):
+        '''
+        Returns (parser, match) pairs for content in message order
+        '''
+        content = self.strip_spoilers(content)
+
+        found = []
+        for index in self.candidates(content):
+            parser = self.parsers[index]
+            for match in parser['pattern'].finditer(content):
+                found.append((match.start(), index, parser, match))
+
+        found.sort(key=lambda item: item[:2])
+        return [ (parser, match) for _, _, parser, match in found ]
@@ -0,0 +1,241 @@
+'''
+Central ffmpeg job scheduler
+'''
+
+# Python standard libraries
+import asyncio
+import itertools
+import json
+import os
+from tempfile import mkstemp
+from time import perf_counter
+
+# Local modules
+import http_client
+import metrics
+from config import config
+
+# Job priorities (lower runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Codecs (and video pixel formats) that play everywhere inside an mp4 as they are
+MP4_VIDEO_CODECS = ('h264',)
+MP4_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')
+MP4_AUDIO_CODECS = ('aac', 'mp3')
+
+# Encoder arguments for mp4 output, by transcode plan mode
+PLAN_ARGS = {
+    'remux': [ '-c', 'copy', '-sn', '-dn' ],
+    'audio': [ '-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k', '-sn', '-dn' ],
+    'reencode': [ '-c:v', 'libx264', '-preset', 'medium', '-crf', '23', '-c:a', 'aac', '-b:a', '128k' ],
+}
+
+# Seconds before ffprobe is given up on
+PROBE_TIMEOUT = 30
+
+# Seconds a network input may stall before ffmpeg gives up
+NETWORK_TIMEOUT = 60
+
+class FFmpegError(Exception):
+    '''
+    Raised when ffmpeg exits with an error or produces no output
+    '''
+    def __init__(self, returncode, stderr):
+        self.returncode = returncode
+        self.stderr = stderr
+        lines = stderr.strip().splitlines()
+        super().__init__(lines[-1] if lines else f"ffmpeg exited with {returncode}")
+
+class Job:
+    '''
+    Single ffmpeg run writing to `dest`, shared by all callers awaiting it
+    '''
+    def __init__(self, args, dest, cwd):
+        self.key = (dest, tuple(args))
+        self.args = args
+        self.dest = dest
+        self.cwd = cwd
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.process = None
+
+    def cancel(self):
+        '''
+        Drops the job if queued or kills ffmpeg if it is running
+        '''
+        self.future.cancel()
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+
+_queue = None
+_workers = []
+_inflight = {}
+_sequence = itertools.count()
+
+def worker_count():
+    '''
+    Concurrent ffmpeg processes: `ffmpeg.workers` or half of the CPU cores
+    '''
+    return (config.get('ffmpeg') or {}).get('workers') or max(1, (os.cpu_count() or 2) // 2)
+
+async def _execute(job):
+    fd, output = mkstemp(dir=http_client.staging_path(), suffix=os.path.splitext(job.dest)[1])
+    os.close(fd)
+
+    try:
+        job.process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', *job.args, output,
+            cwd=job.cwd, stdin=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await job.process.communicate()
+        stderr = stderr.decode(errors='replace')
+
+        if job.process.returncode != 0:
+            raise FFmpegError(job.process.returncode, stderr)
+        if os.path.getsize(output) == 0:
+            raise FFmpegError(job.process.returncode, stderr or 'ffmpeg produced an empty file')
+
+        # ffmpeg -y keeps the 0600 mode of the pre-created file
+        os.chmod(output, http_client.FILE_MODE)
+        os.replace(output, job.dest)
+    finally:
+        if os.path.exists(output):
+            os.unlink(output)
+
+async def _worker():
+    while True:
+        _, _, job = await _queue.get()
+        try:
+            if not job.future.done():
+                with metrics.timer('ffmpeg'):
+                    await _execute(job)
+                if not job.future.done():
+                    job.future.set_result(job.dest)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            if _inflight.get(job.key) is job:
+                del _inflight[job.key]
+            _queue.task_done()
+
+def start():
+    '''
+    Start the worker tasks (on first use)
+    '''
+    global _queue
+    if _queue is None:
+        _queue = asyncio.PriorityQueue()
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(worker_count()))
+
+async def run(args, dest, priority=PRIORITY_BACKGROUND, cwd=None):
+    '''
+    Runs `ffmpeg [args] <output>` and atomically moves output to dest
+
+    Identical requests (same args and dest) in flight share one job, which is
+    killed once every caller awaiting it has been cancelled.
+    '''
+    start()
+
+    args = list(args)
+    job = _inflight.get((dest, tuple(args)))
+    if job is None or job.future.done():
+        job = Job(args, dest, cwd)
+        _inflight[job.key] = job
+        _queue.put_nowait((priority, next(_sequence), job))
+
+    job.waiters += 1
+    try:
+        return await asyncio.shield(job.future)
+    except asyncio.CancelledError:
+        if job.waiters == 1:
+            job.cancel()
+        raise
+    finally:
+        job.waiters -= 1
+
+def url_input(url, headers=None):
+    '''
+    Input arguments reading url directly (streamed, seekable with range
+    requests), so transcoding overlaps with the download
+    '''
+    args = [ '-rw_timeout', str(NETWORK_TIMEOUT * 1000000) ]
+    if headers:
+        args += [ '-headers', ''.join(f"{key}: {value}\r\n" for key, value in headers.items()) ]
+    return [ *args, '-i', url ]
+
+async def probe(source, cwd=None):
+    '''
+    Returns ffprobe stream and format information of a file or URL
+    '''
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', source,
+        cwd=cwd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), PROBE_TIMEOUT)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise FFmpegError(process.returncode, stderr.decode(errors='replace'))
+    return json.loads(stdout)
+
+async def plan(source, cwd=None):
+    '''
+    Picks the cheapest way to turn source into a widely playable mp4
+
+    Returns a dict with `mode` (remux, audio or reencode), ffmpeg codec
+    `args`, the `source` codecs and the `probe` time in seconds. Sources
+    which cannot be probed are re-encoded.
+    '''
+    start = perf_counter()
+    try:
+        info = await probe(source, cwd)
+    except (FFmpegError, OSError, asyncio.TimeoutError, ValueError) as e:
+        print(f"[ffmpeg] ffprobe failed for {source}: {e}")
+        info = { 'streams': [] }
+    elapsed = perf_counter() - start
+
+    video = [ stream for stream in info['streams'] if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic') ]
+    audio = [ stream for stream in info['streams'] if stream.get('codec_type') == 'audio' ]
+
+    # Judge the streams ffmpeg maps by default: the highest resolution video
+    # and the audio with the most channels (HLS master playlists list the
+    # streams of every variant)
+    video = max(video, key=lambda stream: stream.get('width', 0) * stream.get('height', 0), default=None)
+    audio = max(audio, key=lambda stream: stream.get('channels', 0), default=None)
+
+    video_ok = video is not None and video.get('codec_name') in MP4_VIDEO_CODECS and video.get('pix_fmt') in MP4_PIXEL_FORMATS
+    audio_ok = audio is None or audio.get('codec_name') in MP4_AUDIO_CODECS
+
+    if video_ok and audio_ok:
+        mode = 'remux'
+    elif video_ok:
+        mode = 'audio'
+    else:
+        mode = 'reencode'
+
+    codecs = '/'.join(stream.get('codec_name', '?') for stream in (video, audio) if stream is not None) or 'unknown'
+    return { 'mode': mode, 'args': list(PLAN_ARGS[mode]), 'source': codecs, 'probe': elapsed }
+
+async def close():
+    '''
+    Stop the workers, killing running ffmpeg processes (called on shutdown)
+    '''
+    global _queue
+    for job in list(_inflight.values()):
+        job.cancel()
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _inflight.clear()
+    _queue = None
@@ -6,25 +6,36 @@ Definiton of hander functions for sourcebot.
 import asyncio
 import os
 import shlex
-import shutil
-from atproto import Client
+import traceback
+from atproto import AsyncClient
+from atproto.exceptions import UnauthorizedError
 from re import sub
-from tempfile import TemporaryDirectory
 from time import perf_counter
 import re
 
 # Third-party libraries
-import aiofiles
 import discord
 import xmltodict
-from aiohttp import ClientSession, BasicAuth, ContentTypeError
-from pymongo import MongoClient
-from yt_dlp import YoutubeDL
+from aiohttp import ClientResponseError, ContentTypeError
 
 # Local modules
+import database
+import ffmpeg
+import http_client
+import media_cache
+import storage
+import tiktok_pool
+import ytdl
+import cache
 from config import config
+from ratelimit import TokenBucket
 
 # Source fetching
+async def fetch_phixiv(illust_id):
+    session = http_client.session()
+    async with session.get(f"https://www.phixiv.net/api/info?id={illust_id}") as response:
+        return await response.json()
+
 async def pixiv(**kwargs):
     '''
     Hander for pixiv.net
@@ -35,9 +46,7 @@ async def pixiv(**kwargs):
 
     print(illust_id)
 
-    async with ClientSession() as session:
-        async with session.get(f"https://www.phixiv.net/api/info?id={illust_id}") as response:
-            data = await response.json()
+    data = await cache.memoize('phixiv', illust_id, lambda: fetch_phixiv(illust_id))
 
     embeds = []
     for index, url in enumerate(data['image_proxy_urls']):
@@ -46,6 +55,47 @@ async def pixiv(**kwargs):
         embeds.append(embed)
     return [ { 'embeds': embeds[i:i+10] } for i in range(0, len(embeds), 10) ]
 
+# Cached inkbunny API session ID (renewed when the API reports it invalid)
+inkbunny_sid = None
+inkbunny_login_lock = asyncio.Lock()
+
+# Inkbunny API error code for an invalid or expired session ID
+INKBUNNY_INVALID_SESSION = 2
+
+# Concurrent inkbunny file downloads per submission
+INKBUNNY_DOWNLOADS = 4
+
+async def inkbunny_login(session, expired_sid=None):
+    '''
+    Log in to inkbunny API, unless another request already replaced `expired_sid`
+    '''
+    global inkbunny_sid
+    async with inkbunny_login_lock:
+        if inkbunny_sid is None or inkbunny_sid == expired_sid:
+            async with session.get("https://inkbunny.net/api_login.php",
+                    params = { 'username': config['inkbunny']['username'], 'password': config['inkbunny']['password'] }
+                ) as response:
+                data = await response.json()
+                inkbunny_sid = data['sid']
+        return inkbunny_sid
+
+async def inkbunny_api(session, endpoint, **params):
+    '''
+    Inkbunny API request with the cached session ID, logging in again only
+    when the API reports the session as invalid
+    '''
+    sid = inkbunny_sid or await inkbunny_login(session)
+    for retry in (False, True):
+        if retry:
+            sid = await inkbunny_login(session, expired_sid=sid)
+
+        async with session.get(f"https://inkbunny.net/{endpoint}", params = { 'sid': sid, **params }) as response:
+            data = await response.json()
+
+        if data.get('error_code') != INKBUNNY_INVALID_SESSION:
+            break
+    return data
+
 async def inkbunny(**kwargs):
     '''
     Hander for inkbunny.net
@@ -55,41 +105,43 @@ async def inkbunny(**kwargs):
     submission_id = kwargs['match'].group(1)
     page = kwargs['match'].group(2)
 
-    async with ClientSession() as session:
-        # Log in to API and get session ID
-        async with session.get("https://inkbunny.net/api_login.php",
-                params = { 'username': config['inkbunny']['username'], 'password': config['inkbunny']['password'] }
-            ) as response:
-            data = await response.json()
-            session_id = data['sid']
+    session = http_client.session()
 
-        # Request information about the submission
-        async with session.get(f"https://inkbunny.net/api_submissions.php?sid={session_id}&submission_ids={submission_id}") as response:
-            data = await response.json()
+    # Request information about the submission
+    data = await inkbunny_api(session, "api_submissions.php", submission_ids=submission_id)
 
-        # Get submission data
-        submission = data['submissions'][0]
+    # Get submission data
+    submission = data['submissions'][0]
+    submission_files = [ submission['files'][int(page) - 1] ] if page else submission['files']
 
-        # Parse and embed all files
-        files = []
-        if page:
-            page_id = int(page)
-            
-            path = f"{config['media']['path']}/inkbunny-{submission['files'][page_id - 1]['file_name']}"
-            if not os.path.exists(path):
-                async with session.get(submission['files'][page_id - 1]['file_url_full']) as response, aiofiles.open(path, "wb") as file:
-                    await file.write(await response.read()) 
-            files.append(path)
+    # Download all files with bounded concurrency, keeping page order
+    downloads = asyncio.Semaphore(INKBUNNY_DOWNLOADS)
 
+    async def fetch(submission_file):
+        path = f"{config['media']['path']}/inkbunny-{submission_file['file_name']}"
+        if os.path.exists(path):
+            storage.touch(os.path.basename(path))
         else:
-            for submission_file in submission['files']:
-                path = f"{config['media']['path']}/inkbunny-{submission_file['file_name']}"
-                if not os.path.exists(path):
-                    async with session.get(submission_file['file_url_full']) as response, aiofiles.open(path, "wb") as file:
-                        await file.write(await response.read()) 
-                files.append(path)
-    
-    return files
+            async with downloads:
+                await http_client.download(submission_file['file_url_full'], path)
+        return path
+
+    return list(await asyncio.gather(*(fetch(submission_file) for submission_file in submission_files)))
+
+# e621 API rate limit (https://e621.net/help/api: 2 requests per second at most)
+e621_limiter = TokenBucket(rate=2, capacity=2)
+
+# Posts resolved per e621 search request and concurrent e621 file downloads
+E621_BATCH_SIZE = 100
+E621_DOWNLOADS = 4
+
+async def e621_api(session, path, **params):
+    '''
+    Rate limited e621 API request
+    '''
+    async with e621_limiter:
+        async with session.get(f"https://e621.net/{path}", params=params) as response:
+            return await response.json()
 
 async def e621(**kwargs):
     '''
@@ -103,15 +155,11 @@ async def e621(**kwargs):
     # Post ID from params
     post_id = kwargs['match'].group(1)
 
-    async with ClientSession(auth = BasicAuth(config['e621']['username'], config['e621']['api_key'])) as session:
-        session.headers.update({
-            'User-Agent': f"sourcebot by {config['e621']['username']}"
-        })
+    session = http_client.session('e621')
 
-        # Get image data using API Endpoint
-        async with session.get(f"https://e621.net/posts/{post_id}.json") as response:
-            data = await response.json()
-            post = data['post']
+    # Get image data using API Endpoint
+    data = await e621_api(session, f"posts/{post_id}.json")
+    post = data['post']
 
     embed = discord.Embed(title=f"Picture by {post['tags']['artist'][0]}", color=discord.Color(0x00549E))
     embed.set_image(url=post['sample']['url'])
@@ -125,30 +173,35 @@ async def e621_pools(**kwargs):
     # Pool ID from params
     pool_id = kwargs['match'].group(1)
 
-    # Parse and embed all files
-    files = []
-    async with ClientSession(auth = BasicAuth(config['e621']['username'], config['e621']['api_key'])) as session:
-        session.headers.update({
-            'User-Agent': f"sourcebot by {config['e621']['username']}"
-        })
+    session = http_client.session('e621')
 
-        # Get image data using API Endpoint
-        async with session.get(f"https://e621.net/pools/{pool_id}.json") as response:
-            pool_data = await response.json()
-    
-            for submission_id in pool_data['post_ids']:
-                async with session.get(f"https://e621.net/posts/{submission_id}.json") as response:
-                    data = await response.json()
-                    post = data['post']
-        
-                    path = f"{config['media']['path']}/e6-{post['file']['md5']}.{post['file']['ext']}"
+    # Get pool data using API Endpoint
+    pool_data = await e621_api(session, f"pools/{pool_id}.json")
+    post_ids = pool_data['post_ids']
 
-                    if not os.path.exists(path):
-                        async with session.get(post['file']['url']) as response, aiofiles.open(path, "wb") as file:
-                            await file.write(await response.read())    
+    # Resolve pool posts with batched searches instead of one request per post
+    batches = await asyncio.gather(*(
+        e621_api(session, "posts.json", tags=f"id:{','.join(map(str, batch))}", limit=len(batch))
+        for batch in (post_ids[i:i+E621_BATCH_SIZE] for i in range(0, len(post_ids), E621_BATCH_SIZE))
+    ))
+    posts = { post['id']: post for data in batches for post in data['posts'] }
 
-                    files.append(path)
-    return files
+    # Download all files with bounded concurrency, keeping pool order
+    downloads = asyncio.Semaphore(E621_DOWNLOADS)
+
+    async def fetch(post):
+        path = f"{config['media']['path']}/e6-{post['file']['md5']}.{post['file']['ext']}"
+        if os.path.exists(path):
+            storage.touch(os.path.basename(path))
+        else:
+            async with downloads:
+                await http_client.download(post['file']['url'], path, session)
+        return path
+
+    return list(await asyncio.gather(*(
+        fetch(posts[post_id]) for post_id in post_ids
+        if post_id in posts and posts[post_id]['file']['url']
+    )))
 
 async def furaffinity(**kwargs):
     '''
@@ -158,16 +211,23 @@ async def furaffinity(**kwargs):
     # Submission ID from params
     submission_id = kwargs['match'].group(1)
 
-    async with ClientSession() as session:
-        async with session.get(f"https://www.xfuraffinity.net/view/{submission_id}") as response:
-            match = re.search(
-                r'<meta\s+property="og:image:secure_url"\s+content="([^"]+)"',
-                await response.text(),
-            )
-            image_url = match.group(1) if match else None
+    session = http_client.session()
+    async with session.get(f"https://www.xfuraffinity.net/view/{submission_id}") as response:
+        match = re.search(
+            r'<meta\s+property="og:image:secure_url"\s+content="([^"]+)"',
+            await response.text(),
+        )
+        image_url = match.group(1) if match else None
 
     return [ { 'content' : image_url } ]
 
+async def fetch_booru_url(page_url, post_id):
+    session = http_client.session()
+    async with session.get(f"https://{page_url}/index.php?page=dapi&s=post&q=index&id={post_id}") as response:
+        data = xmltodict.parse(await response.text())
+
+    return data['posts']['post']['@file_url'] if '@file_url' in data['posts']['post'] else data['posts']['post']['file_url']
+
 async def booru(**kwargs):
     '''
     Hander for booru sites (rule34.xxx, gelbooru.com)
@@ -181,16 +241,17 @@ async def booru(**kwargs):
     if kwargs['message'].embeds and kwargs['message'].embeds[0].thumbnail.url is not discord.Embed.Empty:
         return
 
-    async with ClientSession() as session:
-        async with session.get(f"https://{page_url}/index.php?page=dapi&s=post&q=index&id={post_id}") as response:
-            data = xmltodict.parse(await response.text())
-
-    url = data['posts']['post']['@file_url'] if '@file_url' in data['posts']['post'] else data['posts']['post']['file_url']
+    url = await cache.memoize('booru', (page_url, post_id), lambda: fetch_booru_url(page_url, post_id))
 
     embed = discord.Embed(color=discord.Color(0xABE5A4))
     embed.set_image(url=url)
     return [ { 'embed': embed } ]
 
+async def fetch_deviantart(url):
+    session = http_client.session()
+    async with session.get(f"https://backend.deviantart.com/oembed?url={url}") as response:
+        return await response.json()
+
 async def deviantart(**kwargs):
     '''
     Handler for deviantart.com
@@ -199,14 +260,25 @@ async def deviantart(**kwargs):
     url = kwargs['match'].group(1)
 
     if not kwargs['message'].embeds:
-        async with ClientSession() as session:
-            async with session.get(f"https://backend.deviantart.com/oembed?url={url}") as response:
-                data = await response.json()
+        data = await cache.memoize('deviantart', url, lambda: fetch_deviantart(url))
 
         embed = discord.Embed(color=discord.Color(0xABE5A4))
         embed.set_image(url=data['url'])
         return [ { 'embed': embed } ]
 
+async def fetch_mastodon(domain_url, post_url, post_id):
+    '''
+    Returns status data, or None for statuses that embed fine on their own
+    '''
+    session = http_client.session()
+    async with session.get(f"https://{domain_url}/api/oembed?url={post_url}") as response:
+        # Skip links that return valid embed
+        if response.status == 200:
+            return None
+
+    async with session.get(f"https://{domain_url}/api/v1/statuses/{post_id}") as response:
+        return await response.json()
+
 async def mastodon(**kwargs):
     '''
     Hander for mastodon (baraag.net, pawoo.net)
@@ -217,17 +289,10 @@ async def mastodon(**kwargs):
     domain_url = kwargs['match'].group(1)
     post_id = kwargs['match'].group(2)
 
-    async with ClientSession() as session:
-        async with session.get(f"https://{domain_url}/api/oembed?url={post_url}") as response:
-            # Skip links that return valid embed
-            if response.status == 200:
-                return
-
-        async with session.get(f"https://{domain_url}/api/v1/statuses/{post_id}") as response:
-            data = await response.json()
+    data = await cache.memoize('mastodon', (domain_url, post_id), lambda: fetch_mastodon(domain_url, post_url, post_id))
 
-    # Skip statuses without media attachments
-    if 'media_attachments' not in data:
+    # Skip statuses with valid embed or without media attachments
+    if not data or 'media_attachments' not in data:
         return
 
     # Parse and embed all files
@@ -238,6 +303,9 @@ async def mastodon(**kwargs):
         embeds.append(embed)
     return [ { 'embeds': embeds[i:i+10] } for i in range(0, len(embeds), 10) ]
 
+# References to running fire-and-forget tasks
+background_tasks = set()
+
 twitter_ai = [
     'AZoomerrr'
 ]
@@ -246,6 +314,32 @@ bsky_ai = [
     'l3nkart.bsky.social'
 ]
 
+async def fetch_tweet(tweet_id):
+    '''
+    Returns fxtwitter data, or None for tweets without media
+    '''
+    session = http_client.session()
+    async with session.get(f"https://api.fxtwitter.com/sourcebot/status/{tweet_id}") as response:
+        tweet_data = await response.json()
+
+    if tweet_data['code'] != 200 or 'tweet' not in tweet_data or 'media' not in tweet_data['tweet']:
+        return None
+    return tweet_data
+
+async def fetch_twitter_oembed(tweet_path):
+    '''
+    Returns 'error' or 'invalid' when twitter's own embed fails, None when it is valid
+    '''
+    session = http_client.session()
+    async with session.get(f"https://publish.twitter.com/oembed?url=https://x.com/{tweet_path}") as response:
+        try:
+            oEmbed_data = await response.json()
+        except ContentTypeError as e:
+            print('ContentTypeError! Forcing.', e.message)
+            return 'invalid'
+
+    return 'error' if 'error' in oEmbed_data else None
+
 async def twitter(**kwargs):
     '''
     Hander for twitter.com
@@ -256,101 +350,100 @@ async def twitter(**kwargs):
     tweet_path = kwargs['match'].group(2)
     tweet_id = tweet_path.split('/')[-1]
 
-    async with ClientSession() as session:
-        async with session.get(f"https://api.fxtwitter.com/sourcebot/status/{tweet_id}") as response:
-            tweet_data = await response.json()
-
-        if tweet_data['code'] != 200 or 'tweet' not in tweet_data or 'media' not in tweet_data['tweet']:
-            return
-
-        if tweet_data['tweet']['author']['screen_name'] in twitter_ai:
-            await kwargs['message'].edit(suppress=True)
-            await kwargs['message'].add_reaction("<:ai:1486104620471160964>")
-            return
-
-        media = tweet_data['tweet']['media']
-
-        links = []
-        if 'videos' in media:
-            for index, video in enumerate(media['videos']):
-                if video['type'] == 'gif':
-                    with TemporaryDirectory() as tmpdir:
-                        async with aiofiles.open(f"{tmpdir}/{tweet_id}-{index}.mp4", "wb") as file, session.get(video['url']) as response:
-                            await file.write(await response.read())
-
-                        args = shlex.split(
-                            f"ffmpeg -loglevel fatal -hide_banner -y -i {tweet_id}-{index}.mp4 "
-                            "-vf 'scale=480:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse' -loop 0 "
-                            f"{tweet_id}-{index}.gif"
-                        )
-
-                        ffmpeg = await asyncio.create_subprocess_exec(*args, cwd=os.path.abspath(tmpdir))
-                        await ffmpeg.wait()
-
-                        shutil.move(f"{tmpdir}/{tweet_id}-{index}.gif", f"{config['media']['path']}/tweet-{tweet_id}-{index}.gif")
-                        links.append(f"{config['media']['url']}/tweet-{tweet_id}-{index}.gif")
-                else:
-                    links.append(video['url'])
-
-        if 'photos' in media:
-            async with session.get(f"https://publish.twitter.com/oembed?url=https://x.com/{tweet_path}") as response:
-                try:
-                    oEmbed_data = await response.json()
-                    if not is_vx and 'error' in oEmbed_data:
-                        for photos in media['photos']:
-                            links.append(photos['url'])
-
-                except ContentTypeError as e:
-                    print('ContentTypeError! Forcing.', e.message)
-                    for photos in media['photos']:
-                        links.append(photos['url'])
-
-        if links:
-            return [ { 'content' : "\n".join(links) } ]
+    tweet_data = await cache.memoize('fxtwitter', tweet_id, lambda: fetch_tweet(tweet_id))
+    if not tweet_data:
+        return
 
-async def tiktok(**kwargs):
+    if tweet_data['tweet']['author']['screen_name'] in twitter_ai:
+        await kwargs['message'].edit(suppress=True)
+        await kwargs['message'].add_reaction("<:ai:1486104620471160964>")
+        return
+
+    media = tweet_data['tweet']['media']
+
+    links = []
+    if 'videos' in media:
+        for index, video in enumerate(media['videos']):
+            if video['type'] == 'gif':
+                filename = await media_cache.lookup('twitter', tweet_id, f"gif-{index}")
+                if not filename:
+                    filename = f"tweet-{tweet_id}-{index}.gif"
+                    args = ffmpeg.url_input(video['url']) + shlex.split(
+                        "-vf 'scale=480:-1:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse' -loop 0"
+                    )
+                    await ffmpeg.run(args, f"{config['media']['path']}/{filename}")
+                    await media_cache.store('twitter', tweet_id, filename, f"gif-{index}")
+
+                links.append(f"{config['media']['url']}/{filename}")
+            else:
+                links.append(video['url'])
+
+    if 'photos' in media:
+        oEmbed_error = await cache.memoize('twitter_oembed', tweet_path, lambda: fetch_twitter_oembed(tweet_path))
+        if oEmbed_error == 'invalid' or (oEmbed_error == 'error' and not is_vx):
+            for photos in media['photos']:
+                links.append(photos['url'])
+
+    if links:
+        return [ { 'content' : "\n".join(links) } ]
+
+async def resolve_tiktok(message_url):
     '''
-    Handler for tiktok
+    Returns full tiktok video URL for a short link
     '''
-
-    # Tiktok URL from params
-    message_url = kwargs['match'].group(1)
-    async with ClientSession() as session:
-        # Fetch tiktok_id
-        session.headers.update({
+    session = http_client.session()
+    async with session.get(message_url, allow_redirects=True, headers={
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0'
-        })
-        async with session.get(message_url, allow_redirects=True) as response:
-            url = str(response.url).split('?', maxsplit=1)[0] # remove all the junk in query data
-            kk_url = url.replace('tiktok.com', 'kktiktok.com')
+        }) as response:
+        return str(response.url).split('?', maxsplit=1)[0] # remove all the junk in query data
+
+async def fetch_tiktok(url, tiktok_id):
+    '''
+    Makes sure tiktok is in the media directory, returns False if it is unavailable
+    '''
+    # Check for already downloaded tiktok
+    if await media_cache.lookup('tiktok', tiktok_id):
+        return True
 
-        tiktok_id = url.split('/')[-1]
+    # Skip tiktoks which recently failed to download (e.g. 403)
+    if cache.lookup('tiktok', tiktok_id) is not cache.MISSING:
+        return False
 
-        # Prepare mongodb connection
-        client = MongoClient(config['mongo']['uri'])
-        cached_data = client['sourcebot']['tiktok_db'].find_one({
-            'tiktok_id': int(tiktok_id)
+    # Fetch data from kktiktok
+    kk_url = url.replace('tiktok.com', 'kktiktok.com')
+    try:
+        await http_client.download(kk_url, f"{config['media']['path']}/tiktok-{tiktok_id}.mp4", headers={
+            'User-Agent': 'Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)'
         })
+    except ClientResponseError:
+        cache.store('tiktok', tiktok_id, None)
+        return False
+
+    size = await media_cache.store('tiktok', tiktok_id, f"tiktok-{tiktok_id}.mp4")
+    if not await database.find_tiktok(int(tiktok_id)):
+        await database.add_tiktok(int(tiktok_id), size)
+    tiktok_pool.add(int(tiktok_id))
+    return True
 
-        if not cached_data:
-            # Fetch data from kktiktok
-            session.headers.update({
-                'User-Agent': 'Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)'
-            })
+async def tiktok(**kwargs):
+    '''
+    Handler for tiktok
+    '''
 
-            with TemporaryDirectory() as tmpdir:
-                async with aiofiles.open(f"{tmpdir}/tiktok-{tiktok_id}.mp4", "wb") as file, session.get(kk_url) as response:
-                    if response.status == 403:
-                        return
-                    
-                    await file.write(await response.read())
+    # Tiktok URL from params
+    message_url = kwargs['match'].group(1)
 
-                shutil.move(f"{tmpdir}/tiktok-{tiktok_id}.mp4", f"{config['media']['path']}/tiktok-{tiktok_id}.mp4")
+    # Fetch tiktok_id (full video links already contain it, short links need resolving)
+    if '/video/' in message_url:
+        url = message_url
+    else:
+        url = await cache.memoize('tiktok_link', message_url, lambda: resolve_tiktok(message_url))
 
-            client['sourcebot']['tiktok_db'].insert_one({
-                'tiktok_id': int(tiktok_id),
-                'size': os.stat(f"{config['media']['path']}/tiktok-{tiktok_id}.mp4").st_size
-            })
+    tiktok_id = url.split('/')[-1]
+
+    # Concurrent requests for one tiktok share a single download
+    if not await cache.single_flight(('tiktok', tiktok_id), lambda: fetch_tiktok(url, tiktok_id)):
+        return
 
     return [ { 'content': f"{config['media']['url']}/tiktok-{tiktok_id}.mp4" } ]
 
@@ -359,29 +452,37 @@ async def reddit(**kwargs):
     Handler for reddit
     '''
 
-    async with ClientSession() as session:
-        async with session.get(kwargs['match'].group(1) + '.json') as response:
-            data_raw = await response.json()
-            data = data_raw[0]['data']['children'][0]['data']
-            unique_id = data['subreddit_id'] + data['id']
-            video_url = data['secure_media']['reddit_video']['fallback_url']
-            audio_url = sub(r'DASH_[0-9]+\.', 'DASH_audio.', video_url)
-
-            with TemporaryDirectory() as tmpdir:
-                async with session.get(video_url) as video, session.get(audio_url) as audio:
-                    async with aiofiles.open(f"{tmpdir}/video.mp4", 'wb') as video_f, aiofiles.open(f"{tmpdir}/audio.mp4", 'wb') as audio_f:
-                        await video_f.write(await video.read())
-                        await audio_f.write(await audio.read())
+    # Post ID from URL
+    post_url = kwargs['match'].group(1)
+    post_id = re.search(r"/comments/(\w+)", post_url).group(1)
 
-                args = shlex.split(
-                    'ffmpeg -loglevel fatal -hide_banner -y -i video.mp4 -i audio.mp4 -c:v copy -c:a aac output.mp4'
-                )
-                ffmpeg = await asyncio.create_subprocess_exec(*args, cwd=os.path.abspath(tmpdir))
-                await ffmpeg.wait()
+    # Concurrent requests for one post share a single download and mux
+    filename = await cache.single_flight(('reddit', post_id), lambda: fetch_reddit(post_url, post_id))
+    return [ { 'content': f"{config['media']['url']}/{filename}" } ]
 
-                shutil.move(f"{tmpdir}/output.mp4", f"{config['media']['path']}/reddit-{unique_id}.mp4")
-
-    return [ { 'content': f"{config['media']['url']}/reddit-{unique_id}.mp4" } ]
+async def fetch_reddit(post_url, post_id):
+    '''
+    Makes sure reddit video is in the media directory, returns its filename
+    '''
+    filename = await media_cache.lookup('reddit', post_id)
+    if filename:
+        return filename
+
+    session = http_client.session()
+    async with session.get(post_url + '.json') as response:
+        data_raw = await response.json()
+        data = data_raw[0]['data']['children'][0]['data']
+        unique_id = data['subreddit_id'] + data['id']
+        video_url = data['secure_media']['reddit_video']['fallback_url']
+        audio_url = sub(r'DASH_[0-9]+\.', 'DASH_audio.', video_url)
+
+    # ffmpeg reads both DASH tracks itself and muxes while they download
+    filename = f"reddit-{unique_id}.mp4"
+    args = [ *ffmpeg.url_input(video_url), *ffmpeg.url_input(audio_url), '-c:v', 'copy', '-c:a', 'aac' ]
+    await ffmpeg.run(args, f"{config['media']['path']}/{filename}")
+
+    await media_cache.store('reddit', post_id, filename)
+    return filename
 
 async def instagram(**kwargs):
     '''
@@ -389,15 +490,53 @@ async def instagram(**kwargs):
     '''
     reel_id = kwargs['match'].group(1)
 
-    with TemporaryDirectory() as tmpdir:
-        async with ClientSession() as session:
-            async with aiofiles.open(f"{tmpdir}/{reel_id}.mp4", "wb") as file:
-                async with session.get(f"https://www.vxinstagram.com/videos/{reel_id}") as response:
-                    await file.write(await response.read())
-                    shutil.move(f"{tmpdir}/{reel_id}.mp4", f"{config['media']['path']}/instagram-{reel_id}.mp4")
+    if not await media_cache.lookup('instagram', reel_id):
+        await http_client.download(f"https://www.vxinstagram.com/videos/{reel_id}", f"{config['media']['path']}/instagram-{reel_id}.mp4")
+        await media_cache.store('instagram', reel_id, f"instagram-{reel_id}.mp4")
 
     return [ { 'content': f"{config['media']['url']}/instagram-{reel_id}.mp4" } ]
 
+# Long-lived bluesky client (access tokens are refreshed by the client when needed)
+bsky_client = None
+bsky_login_lock = asyncio.Lock()
+
+# Fetched bluesky posts by (handle, post_id)
+bsky_posts = cache.TTLCache(maxsize=512, ttl=3600)
+
+async def bsky_login(expired_client=None):
+    '''
+    Returns logged in bluesky client, logging in again only if there is none
+    yet or `expired_client` is still the current one
+    '''
+    global bsky_client
+    async with bsky_login_lock:
+        if bsky_client is None or bsky_client is expired_client:
+            client = AsyncClient()
+            await client.login(config['bsky']['handle'], config['bsky']['password'])
+            if bsky_client is not None:
+                await bsky_client.request.close()
+            bsky_client = client
+        return bsky_client
+
+async def bsky_post(user_handle, post_id):
+    '''
+    Returns (cached) bluesky post, fetched without blocking the event loop
+    '''
+    post = bsky_posts.get((user_handle, post_id))
+    if post is not cache.MISSING:
+        return post
+
+    client = bsky_client or await bsky_login()
+    try:
+        post = await client.get_post(post_id, user_handle)
+    except UnauthorizedError:
+        # Refresh token expired as well, start a new session
+        client = await bsky_login(expired_client=client)
+        post = await client.get_post(post_id, user_handle)
+
+    bsky_posts.set((user_handle, post_id), post)
+    return post
+
 async def bsky(**kwargs):
     '''
     Handler for bsky videos
@@ -409,13 +548,13 @@ async def bsky(**kwargs):
         await kwargs['message'].add_reaction("<:ai:1486104620471160964>")
         return
 
-    # Initialize the client and authenticate
-    client = Client()
-    client.login(config['bsky']['handle'], config['bsky']['password'])
+    filename = await media_cache.lookup('bsky', f"{user_handle}/{post_id}")
+    if filename:
+        return [ { 'content': f"{config['media']['url']}/{filename}" } ]
 
     # Fetch the specific post using the extracted handle and post ID
     try:
-        post = client.get_post(post_id, user_handle)
+        post = await bsky_post(user_handle, post_id)
     except Exception as e:
         return f"Failed to fetch the post: {e}"
 
@@ -437,19 +576,14 @@ async def bsky(**kwargs):
             # Construct the video URL using the DID and reference link
             media_url = f"https://video.bsky.app/watch/{user_did}/{video_blob.ref.link}/playlist.m3u8"
 
-            with TemporaryDirectory() as tmpdir:
-                filename = f"bsky-{video_blob.ref.link}.mp4"
+            filename = f"bsky-{video_blob.ref.link}.mp4"
 
-                args = shlex.split(
-                    f"ffmpeg -loglevel fatal -hide_banner -y -i {media_url} "
-                    "-c:v libx264 -preset medium -crf 23 -c:a aac -b:a 128k "
-                    f"{filename}"
-                )
-                ffmpeg = await asyncio.create_subprocess_exec(*args, cwd=os.path.abspath(tmpdir))
-                await ffmpeg.wait()
-
-                shutil.move(f"{tmpdir}/{filename}", f"{config['media']['path']}/{filename}")
-                return [ { 'content': f"{config['media']['url']}/{filename}" } ]
+            # Bluesky HLS is usually h264/aac already, which only needs a remux
+            plan = await ffmpeg.plan(media_url)
+            print(f"[bsky] {filename}: {plan['mode']} ({plan['source']})")
+            await ffmpeg.run([ *ffmpeg.url_input(media_url), *plan['args'] ], f"{config['media']['path']}/{filename}")
+            await media_cache.store('bsky', f"{user_handle}/{post_id}", filename)
+            return [ { 'content': f"{config['media']['url']}/{filename}" } ]
 
         else:
             return "The media is not an MP4 or compatible HLS video."
@@ -468,24 +602,41 @@ async def youtube(**kwargs):
     if not isinstance(kwargs['message'].channel, discord.DMChannel):
         return
 
+    filename = await media_cache.lookup('youtube', video)
+    if filename:
+        return [ { 'content': f"{config['media']['url']}/{filename}" } ]
+
     print(f"processing {video=}")
 
-    # Download video to temporary directory
-    with TemporaryDirectory() as tmpdir:
-        ydl_opts = {
-            'format': 'bestvideo+bestaudio/best',
-            'merge_output_format': 'mp4',
-            'quiet': True,
-            'extract_flat': True,
-            'outtmpl': f"{tmpdir}/{video}.%(ext)s"
-        }
+    # Reply right away, the download runs in the yt-dlp job queue
+    status = await kwargs['message'].channel.send(f"⏳ Processing `{video}`...")
+    task = asyncio.create_task(youtube_reply(status, video, ytdl.submit(video)))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def youtube_reply(status, video, job):
+    '''
+    Edits youtube status message once its download job completes
+    '''
+    try:
+        filename = await job
+        await media_cache.store('youtube', video, filename)
+    except ytdl.JobError as e:
+        await status.edit(content=f"❌ Failed to download `{video}`: {e}")
+        return
+    except Exception as e:
+        traceback.print_exc()
+        await status.edit(content=f"❌ Failed to download `{video}`: {type(e).__name__}")
+        return
 
-        with YoutubeDL(ydl_opts) as ydl:
-            meta = ydl.extract_info(f"https://youtube.com/watch?v={video}")
-            filename = f"{video}.{meta['ext']}"
+    await status.edit(content=f"{config['media']['url']}/{filename}")
 
-            shutil.move(f"{tmpdir}/{filename}", f"{config['media']['path']}/youtube-{filename}")
-            return [ { 'content': f"{config['media']['url']}/youtube-{filename}"} ]
+# Reply wording of convert, by transcode plan mode
+CONVERT_ACTIONS = {
+    'remux': 'Remuxed {filename} without re-encoding',
+    'audio': 'Converted audio of {filename} to AAC',
+    'reencode': 'Converted {filename} to x264',
+}
 
 # Video files converter
 async def convert(filename, url):
@@ -493,19 +644,32 @@ async def convert(filename, url):
     ffmpeg media converter for .mp4 and .webm
     '''
 
-    with TemporaryDirectory() as tmpdir:
-        init_time = perf_counter()
-        async with ClientSession() as session, session.get(url) as response:
-            async with aiofiles.open(f"{tmpdir}/{filename}", "wb") as file:
-                await file.write(await response.read())
-                args = shlex.split(
-                    f"ffmpeg -loglevel fatal -hide_banner -y -i {filename} "
-                    "-c:v libx264 -preset medium -crf 23 -c:a aac -b:a 128k "
-                    f"discord-{filename}"
-                )
-                ffmpeg = await asyncio.create_subprocess_exec(*args, cwd=os.path.abspath(tmpdir))
-                await ffmpeg.wait()
-                filename = f"discord-{filename}"
-
-                shutil.move(f"{tmpdir}/{filename}", f"{config['media']['path']}/{filename}")
-                return { 'content': f"Converted {filename} to x264 in {perf_counter() - init_time:.2f}s\n{config['media']['url']}/{filename}" }
+    # Attachment URL without its expiring query parameters
+    attachment = url.split('?', maxsplit=1)[0]
+
+    # Attachment id (attachments/<channel>/<id>/<name>) keeps common file
+    # names (video.mp4) of different users apart
+    attachment_id = attachment.rstrip('/').split('/')[-2]
+    output = f"discord-{attachment_id}-{filename}"
+
+    cached = await media_cache.lookup('discord', attachment)
+    if cached:
+        return { 'content': f"Already converted {cached}\n{config['media']['url']}/{cached}" }
+
+    init_time = perf_counter()
+
+    # Stream copy whatever already plays in an mp4, re-encode the rest; ffmpeg
+    # reads the attachment itself, converting while it downloads
+    plan = await ffmpeg.plan(url)
+    transcode_time = perf_counter()
+    try:
+        await ffmpeg.run([ *ffmpeg.url_input(url), *plan['args'] ], f"{config['media']['path']}/{output}", priority=ffmpeg.PRIORITY_INTERACTIVE)
+    except ffmpeg.FFmpegError as e:
+        return { 'content': f"❌ Failed to convert {filename}: {e}" }
+    transcode_time = perf_counter() - transcode_time
+
+    await media_cache.store('discord', attachment, output)
+
+    action = CONVERT_ACTIONS[plan['mode']].format(filename=output)
+    timings = f"{plan['source']}, probe {plan['probe']:.2f}s, download and ffmpeg {transcode_time:.2f}s"
+    return { 'content': f"{action} in {perf_counter() - init_time:.2f}s ({timings})\n{config['media']['url']}/{output}" }
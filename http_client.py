@@ -0,0 +1,157 @@
+'''
+Shared HTTP client sessions for sourcebot handlers
+'''
+
+# Python standard libraries
+import os
+from tempfile import TemporaryDirectory, mkstemp
+
+# Third-party libraries
+import aiofiles
+from aiohttp import BasicAuth, ClientSession, ClientTimeout, TCPConnector
+
+# Local modules
+import metrics
+from config import config
+
+# Connection pool defaults (overridable in the `http` section of main.yml)
+DEFAULTS = {
+    'limit': 100,
+    'limit_per_host': 8,
+    'dns_cache_ttl': 300,
+    'keepalive_timeout': 30,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+}
+
+# Streaming download settings
+CHUNK_SIZE = 256 * 1024
+MAX_DOWNLOAD_SIZE = 512 * 1024 * 1024
+
+# Mode of files created in the media directory (mkstemp creates them 0600,
+# served media must stay readable by the web server like plain open() files)
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+class DownloadTooLarge(Exception):
+    '''
+    Raised when a download exceeds its maximum size
+    '''
+
+_connector = None
+_sessions = {}
+
+def _settings():
+    return { **DEFAULTS, **(config.get('http') or {}) }
+
+def _session_options(name):
+    '''
+    Per-session authentication and default headers, keyed by session name
+    '''
+    if name == 'e621':
+        return {
+            'auth': BasicAuth(config['e621']['username'], config['e621']['api_key']),
+            'headers': { 'User-Agent': f"sourcebot by {config['e621']['username']}" },
+        }
+    if name == 'saucenao':
+        # Keeps SauceNao from overriding the content filters of the search
+        return { 'cookies': { 'show_first': '0' } }
+    return {}
+
+def start():
+    '''
+    Create the shared connection pool (called once on bot startup)
+    '''
+    global _connector
+    if _connector is None or _connector.closed:
+        settings = _settings()
+        _connector = TCPConnector(
+            limit=settings['limit'],
+            limit_per_host=settings['limit_per_host'],
+            ttl_dns_cache=settings['dns_cache_ttl'],
+            keepalive_timeout=settings['keepalive_timeout'],
+        )
+    return _connector
+
+def session(name='default'):
+    '''
+    Returns long-lived session `name`, all sessions share one connection pool
+    '''
+    client = _sessions.get(name)
+    if client is None or client.closed:
+        settings = _settings()
+        client = ClientSession(
+            connector=start(),
+            connector_owner=False,
+            timeout=ClientTimeout(
+                total=None,
+                connect=settings['connect_timeout'],
+                sock_read=settings['read_timeout'],
+            ),
+            trace_configs=[metrics.http_trace(name)],
+            **_session_options(name),
+        )
+        _sessions[name] = client
+    return client
+
+def staging_path():
+    '''
+    Staging directory on the same filesystem as the media directory
+    '''
+    path = os.path.join(config['media']['path'], '.staging')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def staging():
+    '''
+    Temporary working directory inside staging, so moving results into the
+    media directory is an atomic rename instead of a cross-device copy
+    '''
+    return TemporaryDirectory(dir=staging_path())
+
+async def download(url, path, client=None, max_size=None, **kwargs):
+    '''
+    Streams url to path in chunks and returns its size; path only appears
+    once the download is complete
+    '''
+    if max_size is None:
+        max_size = config['media'].get('max_download_size', MAX_DOWNLOAD_SIZE)
+
+    fd, partial = mkstemp(dir=staging_path(), suffix='.part')
+    os.close(fd)
+
+    try:
+        size = 0
+        async with (client or session()).get(url, **kwargs) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > max_size:
+                raise DownloadTooLarge(f"{url} is {response.content_length} bytes (limit {max_size})")
+
+            async with aiofiles.open(partial, 'wb') as file:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise DownloadTooLarge(f"{url} exceeds {max_size} bytes")
+                    await file.write(chunk)
+
+        os.chmod(partial, FILE_MODE)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+    return size
+
+async def close():
+    '''
+    Close every session and the shared connection pool (called on shutdown)
+    '''
+    global _connector
+    for client in _sessions.values():
+        await client.close()
+    _sessions.clear()
+
+    if _connector is not None:
+        await _connector.close()
+        _connector = None
@@ -0,0 +1,159 @@
+'''
+Background mirroring of handler replies to the logs channel
+'''
+
+# Python standard libraries
+import asyncio
+import traceback
+
+# Queued entries before new ones are dropped
+MAX_QUEUED = 1000
+
+# Entries are collected for this many seconds before a batch is sent
+BATCH_DELAY = 2
+
+# Discord limits per message
+MAX_CONTENT = 2000
+MAX_EMBEDS = 10
+
+_queue = None
+_worker_task = None
+
+def entry(header, sent):
+    '''
+    Log entry for replies already posted: their text, embeds and the URLs of
+    their uploaded attachments (files are never uploaded twice)
+    '''
+    lines = [ header ]
+    embeds = []
+    for reply in sent:
+        lines.append(f"<{reply.jump_url}>")
+        if reply.content:
+            lines.append(reply.content)
+        lines.extend(attachment.url for attachment in reply.attachments)
+        embeds.extend(reply.embeds)
+    return { 'content': '\n'.join(lines), 'embeds': embeds }
+
+def submit(channel, log_entry):
+    '''
+    Queues an entry for channel without waiting, dropping it if the queue is full
+    '''
+    start()
+    try:
+        _queue.put_nowait((channel, log_entry))
+    except asyncio.QueueFull:
+        print("[logs] Mirror queue is full, dropping entry")
+
+def _chunks(text):
+    '''
+    Splits text into pieces of at most MAX_CONTENT characters at line
+    boundaries (only a single overlong line is cut)
+    '''
+    chunk = ''
+    for line in text.split('\n'):
+        while len(line) > MAX_CONTENT:
+            if chunk:
+                yield chunk
+                chunk = ''
+            yield line[:MAX_CONTENT]
+            line = line[MAX_CONTENT:]
+
+        joined = f"{chunk}\n{line}" if chunk else line
+        if chunk and len(joined) > MAX_CONTENT:
+            yield chunk
+            joined = line
+        chunk = joined
+
+    if chunk:
+        yield chunk
+
+def _messages(log_entry):
+    '''
+    Messages of one entry: its text split at line boundaries with its embeds
+    on the last piece, and embeds beyond MAX_EMBEDS in messages of their own
+    '''
+    messages = [ (text, []) for text in _chunks(log_entry['content']) ] or [ ('', []) ]
+    embeds = log_entry['embeds']
+    messages[-1] = (messages[-1][0], embeds[:MAX_EMBEDS])
+    for start in range(MAX_EMBEDS, len(embeds), MAX_EMBEDS):
+        messages.append(('', embeds[start:start + MAX_EMBEDS]))
+    return messages
+
+def _batches(entries):
+    '''
+    Packs entries into as few messages as the content and embed limits allow,
+    without cutting any of them short or mixing embeds of different entries
+    into another entry's text
+    '''
+    pending = None
+    for log_entry in entries:
+        messages = _messages(log_entry)
+        if pending is not None:
+            content, embeds = messages[0]
+            joined = f"{pending[0]}\n{content}" if content else pending[0]
+            if len(joined) <= MAX_CONTENT and len(pending[1]) + len(embeds) <= MAX_EMBEDS:
+                messages[0] = (joined, pending[1] + embeds)
+            else:
+                yield pending
+
+        yield from messages[:-1]
+
+        # Only a text piece takes the next entry, leftover embeds go on their own
+        pending = messages[-1]
+        if not pending[0]:
+            if pending[1]:
+                yield pending
+            pending = None
+
+    if pending is not None:
+        yield pending
+
+async def _send(channel, entries):
+    for content, embeds in _batches(entries):
+        await channel.send(content=content or None, embeds=embeds)
+
+async def _worker():
+    while True:
+        queued = [ await _queue.get() ]
+        await asyncio.sleep(BATCH_DELAY)
+        while not _queue.empty():
+            queued.append(_queue.get_nowait())
+
+        by_channel = {}
+        for channel, log_entry in queued:
+            by_channel.setdefault(channel, []).append(log_entry)
+
+        try:
+            for channel, entries in by_channel.items():
+                await _send(channel, entries)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            for _ in queued:
+                _queue.task_done()
+
+def start():
+    '''
+    Start the worker task (on first use)
+    '''
+    global _queue, _worker_task
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=MAX_QUEUED)
+        _worker_task = asyncio.create_task(_worker())
+
+async def close(timeout=10):
+    '''
+    Send what is still queued (up to timeout seconds) and stop the worker
+    '''
+    global _queue, _worker_task
+    if _queue is None:
+        return
+
+    try:
+        await asyncio.wait_for(_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        print(f"[logs] Dropped {_queue.qsize()} unsent log entries")
+
+    _worker_task.cancel()
+    await asyncio.gather(_worker_task, return_exceptions=True)
+    _queue = _worker_task = None
@@ -5,12 +5,13 @@ Main source code / entry point for sourcebot
 '''
 
 # Python standard libraries
+import asyncio
 import re
+import traceback
 
 # Third-party libraries
 import discord
 from discord.ext import bridge
-from pysaucenao import SauceNao
 
 # atproto ignore warning
 import warnings
@@ -18,37 +19,121 @@ from pydantic import warnings as pw
 warnings.filterwarnings("ignore", category=pw.UnsupportedFieldAttributeWarning)
 
 # Local modules
+import database
 import handlers
+from dispatcher import Dispatcher
+import ffmpeg
+import http_client
+import log_mirror
+import media_cache
+import metrics
+import sauce
+import storage
+import tiktok_pool
+import uploads
+import ytdl
+import config as config_file
+import routing
 from config import config
 
+class Sourcebot(bridge.Bot):
+    '''
+    Bot with shared resources bound to its lifetime
+    '''
+    async def start(self, *args, **kwargs):
+        http_client.start()
+        await media_cache.setup()
+        await tiktok_pool.load()
+        storage.start()
+        await metrics.start()
+        config_file.start()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await log_mirror.close()
+        await super().close()
+        await config_file.close()
+        await metrics.close()
+        await storage.close()
+        await http_client.close()
+        await database.close()
+        await ytdl.close()
+        await ffmpeg.close()
+
 # Prepare bot with intents
 intents = discord.Intents.all()
-bot = bridge.Bot(command_prefix='$', intents=intents)
+bot = Sourcebot(command_prefix='$', intents=intents)
 
 # Spoiler regular expression
 spoiler_regex = re.compile(r"(\|\|.*?\|\||\<.*?\>|\`.*?\`)", re.DOTALL)
 
 # Parser regular expressions list
+# (`hints`: literal substrings, at least one of which every match contains)
 parsers = [
-    { 'pattern': re.compile(r"(?:pixiv\.net[\/\w]*)\/artworks\/(\w+)"), 'function': handlers.pixiv },
-    { 'pattern': re.compile(r"(?<=https://www.furaffinity.net/view/)(\w+)"), 'function': handlers.furaffinity },
-    # { 'pattern': re.compile(r"(?<=https://e621.net/posts/)(\w+)"), 'function': handlers.e621 },
-    { 'pattern': re.compile(r"(gelbooru.com|rule34.xxx)\/.*id\=(\w+)"), 'function': handlers.booru },
-    { 'pattern': re.compile(r"https:\/\/(?:(baraag\.net|pawoo\.net)[.@/\w]*)\/(\w+)"), 'function': handlers.mastodon },
-    { 'pattern': re.compile(r"(fx|vx|fixv|fixup|zz)?(?:twitter\.com|x\.com)\/(\w+\/status\/\w+)"), 'function': handlers.twitter },
-    { 'pattern': re.compile(r"(?:youtu\.be\/|youtube\.com\/(?:embed\/|shorts\/|v\/|watch\?v=|watch\?.+&v=))([\w-]{11})"), 'function': handlers.youtube },
-    { 'pattern': re.compile(r"(https:\/\/(?:(?:v[mt]\.|www\.)tiktok.com(?:\/t)*\/\w+|www.tiktok.com\/@[\w\.]+\/video\/\w+))"), 'function': handlers.tiktok },
-    { 'pattern': re.compile(r"(https:\/\/www.deviantart.com\/[0-9a-zA-z\-\/]+)"), 'function': handlers.deviantart },
-    { 'pattern': re.compile(r"(https:\/\/(?:www\.)*reddit.com\/r\/.+?\/comments\/.+?\/.+?)\/\?*"), 'function': handlers.reddit },
-    # { 'pattern': re.compile(r"\.instagram.com\/reel\/([\w-]+)"), 'function': handlers.instagram },
-    { 'pattern': re.compile(r"https:\/\/bsky.app\/profile\/([.\w]+)\/post\/(\w+)"), 'function': handlers.bsky }
+    { 'pattern': re.compile(r"(?:pixiv\.net[\/\w]*)\/artworks\/(\w+)"), 'function': handlers.pixiv, 'hints': ('pixiv.net',) },
+    { 'pattern': re.compile(r"(?<=https://www.furaffinity.net/view/)(\w+)"), 'function': handlers.furaffinity, 'hints': ('furaffinity',) },
+    # { 'pattern': re.compile(r"(?<=https://e621.net/posts/)(\w+)"), 'function': handlers.e621, 'hints': ('e621',) },
+    { 'pattern': re.compile(r"(gelbooru.com|rule34.xxx)\/.*id\=(\w+)"), 'function': handlers.booru, 'hints': ('gelbooru', 'rule34') },
+    { 'pattern': re.compile(r"https:\/\/(?:(baraag\.net|pawoo\.net)[.@/\w]*)\/(\w+)"), 'function': handlers.mastodon, 'hints': ('baraag.net', 'pawoo.net') },
+    { 'pattern': re.compile(r"(fx|vx|fixv|fixup|zz)?(?:twitter\.com|x\.com)\/(\w+\/status\/\w+)"), 'function': handlers.twitter, 'hints': ('twitter.com', 'x.com') },
+    { 'pattern': re.compile(r"(?:youtu\.be\/|youtube\.com\/(?:embed\/|shorts\/|v\/|watch\?v=|watch\?.+&v=))([\w-]{11})"), 'function': handlers.youtube, 'hints': ('youtu.be', 'youtube.com') },
+    { 'pattern': re.compile(r"(https:\/\/(?:(?:v[mt]\.|www\.)tiktok.com(?:\/t)*\/\w+|www.tiktok.com\/@[\w\.]+\/video\/\w+))"), 'function': handlers.tiktok, 'hints': ('tiktok',) },
+    { 'pattern': re.compile(r"(https:\/\/www.deviantart.com\/[0-9a-zA-z\-\/]+)"), 'function': handlers.deviantart, 'hints': ('deviantart',) },
+    { 'pattern': re.compile(r"(https:\/\/(?:www\.)*reddit.com\/r\/.+?\/comments\/.+?\/.+?)\/\?*"), 'function': handlers.reddit, 'hints': ('reddit',) },
+    # { 'pattern': re.compile(r"\.instagram.com\/reel\/([\w-]+)"), 'function': handlers.instagram, 'hints': ('instagram',) },
+    { 'pattern': re.compile(r"https:\/\/bsky.app\/profile\/([.\w]+)\/post\/(\w+)"), 'function': handlers.bsky, 'hints': ('bsky',) }
 ]
 
+# Parsers returning local file paths instead of message kwargs
 parsers_new = [
-    { 'pattern': re.compile(r"(?<=https://e621.net/pools/)(\w+)"), 'function': handlers.e621_pools },
-    { 'pattern': re.compile(r"(?<=https://inkbunny.net/s/)(\w+)(?:-p)?(\d+)?"), 'function': handlers.inkbunny },
+    { 'pattern': re.compile(r"(?<=https://e621.net/pools/)(\w+)"), 'function': handlers.e621_pools, 'hints': ('e621',), 'files': True },
+    { 'pattern': re.compile(r"(?<=https://inkbunny.net/s/)(\w+)(?:-p)?(\d+)?"), 'function': handlers.inkbunny, 'hints': ('inkbunny',), 'files': True },
 ]
 
+dispatcher = Dispatcher(parsers_new + parsers, spoiler_pattern=spoiler_regex)
+
+# Per-channel behaviour (rebuilt when the config file changes)
+routing.setup(dispatcher)
+
+# Maximum number of handlers running at once for a single message
+HANDLER_CONCURRENCY = 4
+
+async def run_handler(parser, match, message, limit):
+    '''
+    Runs a single handler, reporting (instead of raising) its failure
+    '''
+    async with limit:
+        try:
+            with metrics.timer('handler', handler=parser['function'].__name__):
+                return await parser['function'](
+                    match = match, message = message
+                )
+        except Exception:
+            print(f"{parser['function'].__name__} failed for {match.group(0)}")
+            traceback.print_exc()
+
+async def deliver(message, parser, match, output, mirror=True):
+    '''
+    Posts a handler's output as replies and queues their mirror to the logs channel
+    '''
+    sent = []
+    try:
+        if parser.get('files'):
+            # Uploads packed by size, files over the channel's limit are linked instead
+            groups, links = await uploads.prepare(output, uploads.upload_limit(message))
+            for group in groups:
+                sent.append(await message.channel.send(files=[ discord.File(file) for file in group ]))
+            for content in uploads.link_messages(links):
+                sent.append(await message.channel.send(content))
+        else:
+            for kwargs in output:
+                sent.append(await message.channel.send(**kwargs))
+    finally:
+        # Debug logs (youtube replies are not mirrored)
+        if mirror and sent and parser['function'] is not handlers.youtube:
+            header = f"```\n{message.author=}\n{message.channel=}\n{match.groups()=}\n```"
+            log_mirror.submit(bot.get_channel(config['discord']['logs_channel']), log_mirror.entry(header, sent))
+
 @bot.event
 async def on_ready():
     print('Client is ready!')
@@ -64,81 +149,69 @@ async def on_message(message: discord.Message):
     # Process prefix commands
     await bot.process_commands(message)
 
-    # Ignore text in valid spoiler tag
-    content = re.sub(spoiler_regex, '', message.content)
-
     # Video conversion functionality
     if isinstance(message.channel, discord.DMChannel) and message.attachments:
         video_attachments = False
         for attachment in message.attachments:
             if attachment.filename.endswith(('mp4', 'webm')):
                 video_attachments = True
-                kwargs = await handlers.convert(attachment.filename.replace('webm', 'mp4'), attachment.url)
+                with metrics.timer('handler', handler='convert'):
+                    kwargs = await handlers.convert(attachment.filename.replace('webm', 'mp4'), attachment.url)
                 await message.channel.send(**kwargs)
         
         if video_attachments:
             return
 
-    # Source providing service handlers
-    if len(message.attachments) > 0 and isinstance(message.channel, discord.DMChannel) or message.channel.id in config['discord']['sauce_channels']:
-        sauce = SauceNao(api_key=config['saucenao']['token'], min_similarity=80.0)
-        sources = []
+    # Channel behaviour (sauce lookups, automod, enabled parsers, log mirroring)
+    route = routing.route(message.channel.id)
 
-        for attachment in message.attachments:
-            results = await sauce.from_url(attachment.url)
+    # Source providing service handlers (attachments are looked up concurrently)
+    if message.attachments and (route['sauce'] or isinstance(message.channel, discord.DMChannel)):
+        images = [ attachment for attachment in message.attachments if (attachment.content_type or 'image/').startswith('image/') ]
+        results = await asyncio.gather(*(sauce.find_source(attachment) for attachment in images), return_exceptions=True)
+        sources = [ f"<{result}>" for result in results if isinstance(result, str) ]
 
-            try:
-                sources.append(f"<{results[0].urls[0]}>")
-            except IndexError:
-                print(f"{attachment.url}, {results}")
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, sauce.QuotaExhausted):
+                print(''.join(traceback.format_exception(result)))
 
         if sources:
             source_urls = '\n'.join(sources)
             await message.channel.send(f"Source(s):\n{source_urls}")
 
-    # oc-refs "automod"
-    if message.channel.id == 1479519364721017044:
-        if len(message.attachments) == 0:
-            await message.delete(delay=3)
-
-    # Match and run new parser functions
-    for parser in parsers_new:
-        for match in re.finditer(parser['pattern'], content):
-            files = await parser['function'](
-                match = match, message = message
-            )
-
-            if isinstance(files, list):
-                # Debug logs
-                logs_channel = bot.get_channel(config['discord']['logs_channel'])
-                await logs_channel.send(f"```\n{message.author=}\n{message.channel=}\n{match.groups()=}\n```")
-
-                for i in range(0, len(files), 10):
-                    await message.channel.send(files=[ discord.File(file) for file in files[i:i+10] ])
-                    await logs_channel.send(files=[ discord.File(file) for file in files[i:i+10] ])
-
-    # Match and run all supported handers
-    for parser in parsers:
-        for match in re.finditer(parser['pattern'], content):
-            output = await parser['function'](
-                match = match, message = message
-            )
-
-            if isinstance(output, list):
-                # Debug logs
-                logs_channel = bot.get_channel(config['discord']['logs_channel'])
-                if parser['function'] is not handlers.youtube:
-                    await logs_channel.send(f"```\n{message.author=}\n{message.channel=}\n{match.groups()=}\n```")
-
-                for kwargs in output:
-                    await message.channel.send(**kwargs)
-                    if parser['function'] is not handlers.youtube:
-                        await logs_channel.send(**kwargs)
+        skipped = [ result for result in results if isinstance(result, sauce.QuotaExhausted) ]
+        if skipped:
+            await message.channel.send(f"⏳ Source lookup is paused ({len(skipped)} image(s) skipped), try again in {max(1, round(max(result.retry_after for result in skipped) / 60))} min.")
+
+    # "automod" (oc-refs)
+    if route['automod'] and not message.attachments:
+        await message.delete(delay=3)
+
+    # Match and run all supported handlers concurrently (text in spoiler tags is ignored)
+    with metrics.timer('dispatch'):
+        matches = route['dispatcher'].scan(message.content)
+    limit = asyncio.Semaphore(HANDLER_CONCURRENCY)
+    tasks = [ asyncio.create_task(run_handler(parser, match, message, limit)) for parser, match in matches ]
+
+    # Post replies in match order, each as soon as it and all before it are ready
+    for (parser, match), task in zip(matches, tasks):
+        output = await task
+        if not isinstance(output, list):
+            continue
+
+        try:
+            with metrics.timer('send', handler=parser['function'].__name__):
+                await deliver(message, parser, match, output, mirror=route['mirror'])
+        except Exception:
+            # Other replies of this message are still delivered
+            print(f"Failed to deliver {parser['function'].__name__} output for {match.group(0)}")
+            traceback.print_exc()
 
 # Load cogs
 bot.load_extension('cogs.fun')
 bot.load_extension('cogs.roles')
 bot.load_extension('cogs.reminders')
+bot.load_extension('cogs.stats')
 
 if __name__ == '__main__':
     # Main Loop
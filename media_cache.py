@@ -0,0 +1,64 @@
+'''
+Persistent media index shared by all downloading handlers
+'''
+
+# Python standard libraries
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+
+# Local modules
+import database
+import metrics
+import storage
+from config import config
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def lookup(source, upstream_id, variant=''):
+    '''
+    Returns filename of already stored media, or None (dropping stale entries)
+    '''
+    entry = await database.find_media(source, str(upstream_id), variant)
+    if entry is None:
+        metrics.inc('media_index_lookups_total', source=source, result='miss')
+        return None
+
+    if not os.path.exists(f"{config['media']['path']}/{entry['filename']}"):
+        await database.delete_media(source, str(upstream_id), variant)
+        metrics.inc('media_index_lookups_total', source=source, result='stale')
+        return None
+
+    metrics.inc('media_index_lookups_total', source=source, result='hit')
+    storage.touch(entry['filename'])
+    return entry['filename']
+
+async def store(source, upstream_id, filename, variant=''):
+    '''
+    Records a file stored in the media directory, returns its size
+    '''
+    path = f"{config['media']['path']}/{filename}"
+    await database.add_media({
+        'source': source,
+        'upstream_id': str(upstream_id),
+        'variant': variant,
+        'filename': filename,
+        'size': os.path.getsize(path),
+        'sha256': await asyncio.to_thread(_sha256, path),
+        'created': datetime.now(),
+    })
+    return os.path.getsize(path)
+
+async def setup():
+    '''
+    Prepare the index and migrate legacy tiktok_db entries (called on startup)
+    '''
+    added = await database.migrate_tiktok_media()
+    if added:
+        print(f"[media] Migrated {added} tiktok_db entrie(s) to the media index.")
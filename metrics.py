@@ -0,0 +1,256 @@
+'''
+In-process performance metrics and a Prometheus-format endpoint
+'''
+
+# Python standard libraries
+import bisect
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+# Third-party libraries
+from aiohttp import TraceConfig, web
+from pymongo import monitoring
+
+# Local modules
+import cache
+from config import config
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+# Endpoint defaults (overridable in the `metrics` section of main.yml)
+DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': None, # endpoint disabled when unset
+}
+
+# Metric descriptions, by name (also the list of exported metrics)
+HELP = {
+    'dispatch_seconds': 'Time spent matching message content against the parsers',
+    'handler_seconds': 'Handler run time',
+    'handler_errors_total': 'Handler runs that raised',
+    'send_seconds': 'Time spent posting handler output to Discord',
+    'send_errors_total': 'Failed Discord sends',
+    'http_request_seconds': 'Upstream HTTP request time until response headers',
+    'http_errors_total': 'Upstream HTTP requests that failed before a response',
+    'http_received_bytes_total': 'Upstream HTTP response body bytes received',
+    'ffmpeg_seconds': 'ffmpeg run time',
+    'ffmpeg_errors_total': 'Failed ffmpeg runs',
+    'mongo_seconds': 'MongoDB command time',
+    'mongo_errors_total': 'Failed MongoDB commands',
+    'media_index_lookups_total': 'Media index lookups by result',
+    'saucenao_lookups_total': 'SauceNao lookups by result',
+}
+
+class Histogram:
+    '''
+    Fixed-bucket latency histogram
+    '''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding quantile q
+        '''
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+histograms = {} # (name, labels) -> Histogram
+counters = Counter() # (name, labels) -> value
+gauges = {} # (name, labels) -> last value
+
+_runner = None
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+def inc(name, value=1, **labels):
+    counters[(name, _labels(labels))] += value
+
+def gauge(name, value, **labels):
+    gauges[(name, _labels(labels))] = value
+
+@contextmanager
+def timer(name, **labels):
+    '''
+    Records the duration of the block in histogram `{name}_seconds` and
+    counts it in `{name}_errors_total` if it raises
+    '''
+    start = perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        observe(f"{name}_seconds", perf_counter() - start, **labels)
+
+def http_trace(session):
+    '''
+    aiohttp tracing of request latency, failures and bytes for a named session
+    '''
+    async def on_request_start(_, context, params):
+        context.start = perf_counter()
+
+    async def on_request_end(_, context, params):
+        observe('http_request_seconds', perf_counter() - context.start, session=session, host=params.url.host)
+
+    async def on_request_exception(_, context, params):
+        inc('http_errors_total', session=session, host=params.url.host)
+
+    async def on_response_chunk_received(_, context, params):
+        inc('http_received_bytes_total', len(params.chunk), session=session)
+
+    trace = TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    trace.on_response_chunk_received.append(on_response_chunk_received)
+    return trace
+
+class MongoListener(monitoring.CommandListener):
+    '''
+    Records MongoDB command latency and failures
+    '''
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe('mongo_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        observe('mongo_seconds', event.duration_micros / 1e6, command=event.command_name)
+        inc('mongo_errors_total', command=event.command_name)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def _cache_gauges():
+    '''
+    Metadata cache counters, kept by the cache module itself
+    '''
+    values = { ('metadata_cache_entries', ()): len(cache.metadata) }
+    for source, data in cache.stats().items():
+        values[('metadata_cache_hits_total', (('source', source),))] = data['hits']
+        values[('metadata_cache_misses_total', (('source', source),))] = data['misses']
+    return values
+
+def render():
+    '''
+    All metrics in Prometheus text exposition format
+    '''
+    lines = []
+    for name in sorted({ key[0] for key in histograms }):
+        lines.append(f"# HELP sourcebot_{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE sourcebot_{name} histogram")
+        for (metric, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f"sourcebot_{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"sourcebot_{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"sourcebot_{name}_count{_format_labels(labels)} {histogram.count}")
+
+    for name in sorted({ key[0] for key in counters }):
+        lines.append(f"# HELP sourcebot_{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE sourcebot_{name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"sourcebot_{name}{_format_labels(labels)} {value}")
+
+    values = { **gauges, **_cache_gauges() }
+    for name in sorted({ key[0] for key in values }):
+        lines.append(f"# TYPE sourcebot_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+        for (metric, labels), value in sorted(values.items()):
+            if metric == name:
+                lines.append(f"sourcebot_{name}{_format_labels(labels)} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    '''
+    Per-handler and per-component statistics for the `$stats` command
+    '''
+    handlers = {}
+    for (name, labels), histogram in histograms.items():
+        if name == 'handler_seconds':
+            handler = dict(labels)['handler']
+            handlers[handler] = {
+                'runs': histogram.count,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99),
+                'errors': counters[('handler_errors_total', labels)],
+            }
+
+    def total(name):
+        return sum(value for (metric, _), value in counters.items() if metric == name)
+
+    def merged(name):
+        histogram = Histogram()
+        for (metric, _), part in histograms.items():
+            if metric == name:
+                histogram.counts = [ a + b for a, b in zip(histogram.counts, part.counts) ]
+                histogram.sum += part.sum
+                histogram.count += part.count
+        return histogram
+
+    return {
+        'handlers': handlers,
+        'components': { name: merged(f"{name}_seconds") for name in ('dispatch', 'send', 'http_request', 'ffmpeg', 'mongo') },
+        'errors': { name: total(f"{name}_errors_total") for name in ('send', 'http', 'ffmpeg', 'mongo') },
+        'received_bytes': total('http_received_bytes_total'),
+        'cache': cache.stats(),
+        'media_bytes': sum(value for (name, _), value in gauges.items() if name == 'media_bytes'),
+        'media_files': sum(value for (name, _), value in gauges.items() if name == 'media_files'),
+    }
+
+async def _metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+async def start():
+    '''
+    Starts the endpoint if `metrics.port` is configured (called once on bot startup)
+    '''
+    global _runner
+    settings = { **DEFAULTS, **(config.get('metrics') or {}) }
+    if _runner is not None or not settings['port']:
+        return
+
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, settings['host'], settings['port']).start()
+    print(f"[metrics] Serving on http://{settings['host']}:{settings['port']}/metrics")
+
+async def close():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
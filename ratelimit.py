@@ -0,0 +1,43 @@
+'''
+Request rate limiting for upstream APIs
+'''
+
+# Python standard libraries
+import asyncio
+from time import monotonic
+
+class TokenBucket:
+    '''
+    Token bucket limiter: `rate` tokens per second, bursts up to `capacity`
+
+    Usable as `await bucket.acquire()` or `async with bucket:`.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens=1):
+        '''
+        Waits until `tokens` are available and takes them (waiters are served in order)
+        '''
+        async with self.lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
@@ -0,0 +1,83 @@
+'''
+Per-channel message routing table, rebuilt whenever the config changes
+'''
+
+# Local modules
+from config import config, listeners
+from dispatcher import Dispatcher
+
+# Channels where messages without attachments are removed when no
+# `discord.automod_channels` are configured (oc-refs)
+DEFAULT_AUTOMOD_CHANNELS = [ 1479519364721017044 ]
+
+_dispatcher = None
+_table = {}
+_default = None
+
+def _route(settings, dispatchers):
+    '''
+    Compiled route of one channel from its settings
+    '''
+    parsers = settings.get('parsers')
+    key = None if parsers is None else frozenset(parsers)
+    if key not in dispatchers:
+        unknown = key - { parser['function'].__name__ for parser in _dispatcher.parsers }
+        if unknown:
+            raise ValueError(f"unknown parsers in channel settings: {', '.join(sorted(unknown))}")
+        dispatchers[key] = Dispatcher(
+            [ parser for parser in _dispatcher.parsers if parser['function'].__name__ in key ],
+            spoiler_pattern=_dispatcher.spoiler_pattern,
+        )
+
+    return {
+        'sauce': bool(settings.get('sauce', False)),
+        'automod': bool(settings.get('automod', False)),
+        'mirror': bool(settings.get('mirror', True)),
+        'dispatcher': dispatchers[key],
+    }
+
+def build(new_config):
+    '''
+    Returns (table, default route) for a config
+
+    Channel behaviour comes from `discord.sauce_channels`,
+    `discord.automod_channels` and per-channel overrides in `discord.channels`
+    (`sauce`, `automod`, `mirror`, `parsers`: names of enabled handlers).
+    '''
+    discord_config = new_config['discord']
+    settings = {}
+    for channel_id in discord_config.get('sauce_channels') or []:
+        settings.setdefault(int(channel_id), {})['sauce'] = True
+    for channel_id in discord_config.get('automod_channels', DEFAULT_AUTOMOD_CHANNELS) or []:
+        settings.setdefault(int(channel_id), {})['automod'] = True
+    for channel_id, overrides in (discord_config.get('channels') or {}).items():
+        settings.setdefault(int(channel_id), {}).update(overrides or {})
+
+    dispatchers = { None: _dispatcher }
+    table = { channel_id: _route(channel, dispatchers) for channel_id, channel in settings.items() }
+    return table, _route({}, dispatchers)
+
+def _reloaded(new_config):
+    table, default = build(new_config)
+
+    def apply():
+        global _table, _default
+        _table, _default = table, default
+    return apply
+
+def setup(dispatcher):
+    '''
+    Builds the table around a dispatcher of all parsers and rebuilds it on
+    every config reload
+    '''
+    global _dispatcher
+    _dispatcher = dispatcher
+    _reloaded(config)()
+    if _reloaded not in listeners:
+        listeners.append(_reloaded)
+
+def route(channel_id):
+    '''
+    Route for messages in a channel
+    '''
+    return _table.get(channel_id, _default)
@@ -0,0 +1,181 @@
+'''
+Shared SauceNao source lookup service
+'''
+
+# Python standard libraries
+import hashlib
+from contextlib import nullcontext
+from time import monotonic
+
+# Third-party libraries
+from pysaucenao import SauceNao
+from pysaucenao.errors import RateLimitedError, SauceNaoError
+
+# Local modules
+import cache
+import http_client
+import metrics
+from config import config
+from ratelimit import TokenBucket
+
+# Lookup defaults (overridable in the `saucenao` section of main.yml, free account limits)
+DEFAULTS = {
+    'short_limit': 4, # searches per 30 seconds
+    'min_similarity': 80.0,
+    'max_pending': 16, # queued searches before new ones are refused
+    'max_hash_size': 32 * 1024 * 1024, # larger attachments are cached by URL instead
+    'cache_ttl': 7 * 86400,
+}
+
+# Pause after SauceNao reports a daily limit, by limit type
+LIMIT_PAUSE = {
+    'daily': 3600,
+    'invalid_requests': 3600,
+}
+
+class QuotaExhausted(Exception):
+    '''
+    Raised when the search quota is used up or too many searches are queued
+    '''
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"SauceNao quota exhausted, retry in {retry_after:.0f}s")
+
+class Client(SauceNao):
+    '''
+    SauceNao client on the shared connection pool
+    '''
+    def _session(self):
+        # The library closes the session after each search, the shared one must stay open
+        return nullcontext(http_client.session('saucenao'))
+
+_client = None
+_bucket = None
+_paused_until = 0
+_pending = 0
+results = cache.TTLCache(maxsize=4096, ttl=DEFAULTS['cache_ttl'])
+
+def _settings():
+    return { **DEFAULTS, **(config.get('saucenao') or {}) }
+
+def client():
+    global _client, _bucket
+    if _client is None:
+        settings = _settings()
+        _client = Client(api_key=config['saucenao']['token'], min_similarity=settings['min_similarity'])
+        _bucket = TokenBucket(settings['short_limit'] / 30, settings['short_limit'])
+    return _client
+
+def _pause(seconds):
+    global _paused_until
+    _paused_until = max(_paused_until, monotonic() + seconds)
+
+def _url_key(attachment):
+    # Attachment URL without its expiring query parameters
+    return attachment.url.split('?', maxsplit=1)[0]
+
+async def _content_key(attachment):
+    '''
+    sha256 of attachment content (reposts share it), or its URL if it is too large
+    '''
+    if attachment.size > _settings()['max_hash_size']:
+        return _url_key(attachment)
+
+    digest = hashlib.sha256()
+    async with http_client.session().get(attachment.url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(http_client.CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _check():
+    '''
+    Raises QuotaExhausted if searches are paused or too many are queued
+    '''
+    settings = _settings()
+    if _paused_until > monotonic():
+        raise QuotaExhausted(_paused_until - monotonic())
+    if _pending >= settings['max_pending']:
+        raise QuotaExhausted(30 * _pending / settings['short_limit'])
+
+async def _search(url):
+    '''
+    Searches url once the rate limit allows it, returns first source URL or None
+    '''
+    global _pending
+    _check()
+
+    sauce = client()
+    _pending += 1
+    try:
+        while True:
+            await _bucket.acquire()
+            if _paused_until > monotonic():
+                raise QuotaExhausted(_paused_until - monotonic())
+            try:
+                found = await sauce.from_url(url)
+                break
+            except RateLimitedError as e:
+                if e.limit_type != 'short':
+                    _pause(LIMIT_PAUSE[e.limit_type])
+                    print(f"[saucenao] {e}, pausing searches")
+                    raise QuotaExhausted(_paused_until - monotonic())
+
+                # Out of sync with the 30 second window: empty the bucket and wait in line again
+                _bucket.tokens = 0
+    finally:
+        _pending -= 1
+
+    # Stop before the daily limit is hit instead of after
+    if found.account.api_daily_remaining <= 0:
+        _pause(LIMIT_PAUSE['daily'])
+
+    try:
+        return found[0].urls[0]
+    except IndexError:
+        print(f"{url}, {found}")
+        return None
+
+async def find_source(attachment):
+    '''
+    Returns source URL of an attachment or None
+
+    Results are cached by attachment URL and content, and concurrent lookups
+    of the same image share one search. Raises QuotaExhausted when searches
+    are paused (limit reached) or too many are already queued.
+    '''
+    url_key = _url_key(attachment)
+    key = url_key
+    source = results.get(url_key)
+    if source is cache.MISSING:
+        # Attachments are only downloaded for hashing when a search can follow
+        try:
+            _check()
+        except QuotaExhausted:
+            metrics.inc('saucenao_lookups_total', result='paused')
+            raise
+        key = await _content_key(attachment)
+        source = results.get(key)
+
+    if source is not cache.MISSING:
+        metrics.inc('saucenao_lookups_total', result='cached')
+        if key != url_key:
+            results.set(url_key, source, ttl=_settings()['cache_ttl'] if source else cache.NEGATIVE_TTL)
+        return source
+
+    try:
+        source = await cache.single_flight(('saucenao', key), lambda: _search(attachment.url))
+    except QuotaExhausted:
+        metrics.inc('saucenao_lookups_total', result='paused')
+        raise
+    except SauceNaoError as e:
+        metrics.inc('saucenao_lookups_total', result='error')
+        print(f"[saucenao] {attachment.url}: {e}")
+        return None
+
+    metrics.inc('saucenao_lookups_total', result='found' if source else 'not_found')
+
+    ttl = _settings()['cache_ttl'] if source else cache.NEGATIVE_TTL
+    results.set(key, source, ttl=ttl)
+    results.set(url_key, source, ttl=ttl)
+    return source
@@ -0,0 +1,139 @@
+'''
+Size-budgeted media directory manager with LRU eviction
+'''
+
+# Python standard libraries
+import asyncio
+import os
+import traceback
+from time import time
+
+# Local modules
+import database
+import metrics
+import tiktok_pool
+from config import config
+
+# Filename prefixes of files written by handlers (the only ones ever evicted)
+PREFIXES = ('tiktok-', 'reddit-', 'bsky-', 'youtube-', 'tweet-', 'instagram-', 'inkbunny-', 'e6-', 'discord-')
+
+# Storage defaults (overridable in the `storage` section of main.yml)
+DEFAULTS = {
+    'budget': None, # bytes, no eviction when unset
+    'interval': 600, # seconds between janitor runs
+    'min_age': 3600, # seconds since last access before a file may be evicted
+    'protected': [ 'discord-friday.mp4', 'discord-flat.mov' ],
+}
+
+_janitor = None
+
+def _settings():
+    return { **DEFAULTS, **(config.get('storage') or {}) }
+
+def source_prefix(filename):
+    '''
+    Returns handler prefix of filename, None for files not managed here
+    '''
+    return next((prefix for prefix in PREFIXES if filename.startswith(prefix)), None)
+
+def touch(filename):
+    '''
+    Marks file as just accessed (its mtime is the LRU timestamp)
+    '''
+    try:
+        os.utime(f"{config['media']['path']}/{filename}")
+    except FileNotFoundError:
+        pass
+
+def scan():
+    '''
+    Returns (last access, size, filename) of every managed file (blocking)
+    '''
+    files = []
+    with os.scandir(config['media']['path']) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and source_prefix(entry.name):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+    return files
+
+def usage(files):
+    '''
+    File count and bytes used per source prefix
+    '''
+    totals = { prefix: { 'files': 0, 'bytes': 0 } for prefix in PREFIXES }
+    for _, size, filename in files:
+        totals[source_prefix(filename)]['files'] += 1
+        totals[source_prefix(filename)]['bytes'] += size
+    return totals
+
+async def evict(filename):
+    '''
+    Deletes a stored file and every database entry pointing to it
+    '''
+    try:
+        os.unlink(f"{config['media']['path']}/{filename}")
+    except FileNotFoundError:
+        pass
+
+    await database.delete_media_file(filename)
+    if filename.startswith('tiktok-') and filename.endswith('.mp4'):
+        tiktok_id = filename[len('tiktok-'):-len('.mp4')]
+        if tiktok_id.isdigit():
+            await database.delete_tiktok(int(tiktok_id))
+            tiktok_pool.remove(int(tiktok_id))
+
+async def enforce():
+    '''
+    Evicts least recently used files until usage fits the budget, returns usage
+    '''
+    settings = _settings()
+    files = await asyncio.to_thread(scan)
+    total = sum(size for _, size, _ in files)
+
+    if settings['budget'] and total > settings['budget']:
+        cutoff = time() - settings['min_age']
+        evicted = set()
+        for accessed, size, filename in sorted(files):
+            if total <= settings['budget'] or accessed > cutoff:
+                break
+            if filename in settings['protected']:
+                continue
+
+            await evict(filename)
+            evicted.add(filename)
+            total -= size
+            print(f"[storage] Evicted {filename} ({size} bytes)")
+
+        files = [ file for file in files if file[2] not in evicted ]
+
+    return usage(files)
+
+async def janitor():
+    while True:
+        try:
+            totals = await enforce()
+            for prefix, data in totals.items():
+                metrics.gauge('media_files', data['files'], prefix=prefix)
+                metrics.gauge('media_bytes', data['bytes'], prefix=prefix)
+            summary = ', '.join(f"{prefix}* {data['files']} files/{data['bytes'] / 2**20:.0f} MiB" for prefix, data in totals.items() if data['files'])
+            print(f"[storage] {summary or 'empty'}")
+        except Exception:
+            traceback.print_exc()
+
+        await asyncio.sleep(_settings()['interval'])
+
+def start():
+    '''
+    Start the janitor task (called once on bot startup)
+    '''
+    global _janitor
+    if _janitor is None:
+        _janitor = asyncio.create_task(janitor())
+
+async def close():
+    global _janitor
+    if _janitor is not None:
+        _janitor.cancel()
+        await asyncio.gather(_janitor, return_exceptions=True)
+        _janitor = None
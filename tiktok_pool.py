@@ -0,0 +1,76 @@
+'''
+In-memory pool of collected tiktok ids for random selection
+'''
+
+# Python standard libraries
+import random
+from array import array
+from collections import deque
+
+# Local modules
+import database
+from config import config
+
+# Random picks retried to avoid a recently posted tiktok
+RETRIES = 8
+
+ids = array('Q')
+positions = {} # tiktok id -> index in ids
+recent = {} # channel id -> recently posted tiktok ids
+
+def _no_repeat():
+    '''
+    Number of recent picks per channel not repeated (`tiktok.no_repeat`, 0 disables)
+    '''
+    return (config.get('tiktok') or {}).get('no_repeat', 0)
+
+def add(tiktok_id):
+    if tiktok_id not in positions:
+        positions[tiktok_id] = len(ids)
+        ids.append(tiktok_id)
+
+def remove(tiktok_id):
+    '''
+    Removes tiktok id by moving the last id into its slot
+    '''
+    index = positions.pop(tiktok_id, None)
+    if index is None:
+        return
+
+    last = ids.pop()
+    if last != tiktok_id:
+        ids[index] = last
+        positions[last] = index
+
+async def load():
+    '''
+    Loads every collected tiktok id (called on startup)
+    '''
+    ids_loaded = await database.tiktok_ids()
+    ids[:] = array('Q')
+    positions.clear()
+    for tiktok_id in ids_loaded:
+        add(tiktok_id)
+    print(f"[tiktok] Loaded {len(ids)} tiktok id(s).")
+
+def pick(channel_id=None):
+    '''
+    Returns a random tiktok id (avoiding the channel's recent picks), None if empty
+    '''
+    if not ids:
+        return None
+
+    no_repeat = min(_no_repeat(), len(ids) // 2)
+    if not no_repeat or channel_id is None:
+        return ids[random.randrange(len(ids))]
+
+    history = recent.get(channel_id)
+    if history is None or history.maxlen != no_repeat:
+        history = recent[channel_id] = deque(history or (), maxlen=no_repeat)
+
+    for _ in range(RETRIES):
+        tiktok_id = ids[random.randrange(len(ids))]
+        if tiktok_id not in history:
+            break
+    history.append(tiktok_id)
+    return tiktok_id
@@ -0,0 +1,116 @@
+'''
+Upload planning for handlers returning local files
+'''
+
+# Python standard libraries
+import asyncio
+import os
+
+# Local modules
+import ffmpeg
+from config import config
+
+# Upload limit outside guilds (direct messages)
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+# Files per message and room kept for the rest of the multipart request
+MAX_FILES = 10
+REQUEST_OVERHEAD = 256 * 1024
+
+# Link message length limit
+MAX_CONTENT = 2000
+
+# Upload defaults (overridable in the `uploads` section of main.yml)
+DEFAULTS = {
+    'recompress': False, # shrink oversized images to JPEG instead of linking them
+    'widths': [ 4096, 2560, 1600 ], # widths tried when shrinking, largest first
+}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+def _settings():
+    return { **DEFAULTS, **(config.get('uploads') or {}) }
+
+def upload_limit(message):
+    '''
+    Bytes that fit in one message to the message's channel
+    '''
+    guild = getattr(message, 'guild', None)
+    limit = guild.filesize_limit if guild is not None else DEFAULT_UPLOAD_LIMIT
+    return limit - REQUEST_OVERHEAD
+
+def pack(files, limit):
+    '''
+    Groups (path, size) pairs into uploads of at most MAX_FILES files and
+    `limit` bytes, keeping their order; returns groups and files too large
+    for any upload
+    '''
+    groups, oversized = [], []
+    group, used = [], 0
+    for path, size in files:
+        if size > limit:
+            oversized.append(path)
+            continue
+        if len(group) == MAX_FILES or used + size > limit:
+            groups.append(group)
+            group, used = [], 0
+        group.append(path)
+        used += size
+
+    if group:
+        groups.append(group)
+    return groups, oversized
+
+async def shrink(path, limit):
+    '''
+    Re-encodes an image as a smaller JPEG next to it, returns its path or None
+    if it cannot get under limit
+    '''
+    stem, extension = os.path.splitext(path)
+    if extension.lower() not in IMAGE_EXTENSIONS:
+        return None
+
+    for width in _settings()['widths']:
+        smaller = f"{stem}-{width}w.jpg"
+        if not os.path.exists(smaller):
+            try:
+                await ffmpeg.run([ '-i', path, '-vf', f"scale='min({width},iw)':-2", '-q:v', '3', '-frames:v', '1' ], smaller)
+            except ffmpeg.FFmpegError as e:
+                print(f"[uploads] Failed to shrink {path}: {e}")
+                return None
+        if os.path.getsize(smaller) <= limit:
+            return smaller
+    return None
+
+def media_url(path):
+    return f"{config['media']['url']}/{os.path.basename(path)}"
+
+async def prepare(paths, limit):
+    '''
+    Returns upload groups for paths and media URLs of files that do not fit
+    (after shrinking them, if enabled)
+    '''
+    files = [ (path, os.path.getsize(path)) for path in paths ]
+
+    async def fit(path, size):
+        smaller = await shrink(path, limit) if size > limit else None
+        return (path, size) if smaller is None else (smaller, os.path.getsize(smaller))
+
+    if _settings()['recompress']:
+        files = await asyncio.gather(*(fit(path, size) for path, size in files))
+
+    groups, oversized = pack(files, limit)
+    return groups, [ media_url(path) for path in oversized ]
+
+def link_messages(links):
+    '''
+    Splits links into as few messages as the length limit allows
+    '''
+    content = ''
+    for link in links:
+        if content and len(content) + 1 + len(link) > MAX_CONTENT:
+            yield content
+            content = ''
+        content = f"{content}\n{link}" if content else link
+    if content:
+        yield content
@@ -0,0 +1,125 @@
+'''
+Off-loop yt-dlp job queue for youtube downloads
+'''
+
+# Python standard libraries
+import asyncio
+import os
+import shutil
+import sys
+
+# Local modules
+import http_client
+from config import config
+
+# Job queue defaults (overridable in the `youtube` section of main.yml)
+DEFAULTS = {
+    'workers': 2,
+    'max_height': 1080,
+    'max_filesize': '500M',
+    'fragments': 4,
+    'timeout': 900,
+}
+
+class JobError(Exception):
+    '''
+    Raised when a yt-dlp job fails or times out
+    '''
+
+_queue = None
+_workers = []
+
+def _settings():
+    return { **DEFAULTS, **(config.get('youtube') or {}) }
+
+def _command(video, tmpdir, settings):
+    limits = f"[height<={settings['max_height']}][filesize<?{settings['max_filesize']}]"
+    return [
+        sys.executable, '-m', 'yt_dlp', '--no-warnings', '--no-playlist', '--no-simulate',
+        '--format', f"bestvideo{limits}+bestaudio/best{limits}",
+        '--max-filesize', str(settings['max_filesize']),
+        '--concurrent-fragments', str(settings['fragments']),
+        '--merge-output-format', 'mp4',
+        '--output', f"{tmpdir}/{video}.%(ext)s",
+        '--print', 'after_move:filepath',
+        f"https://youtube.com/watch?v={video}",
+    ]
+
+async def _run(video):
+    '''
+    Downloads video in a yt-dlp subprocess, returns filename in media directory
+    '''
+    settings = _settings()
+    with http_client.staging() as tmpdir:
+        process = await asyncio.create_subprocess_exec(
+            *_command(video, tmpdir, settings),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), settings['timeout'])
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise JobError(f"timed out after {settings['timeout']}s")
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        if process.returncode != 0:
+            errors = stderr.decode(errors='replace').strip().splitlines()
+            raise JobError(errors[-1] if errors else f"yt-dlp exited with {process.returncode}")
+
+        paths = stdout.decode(errors='replace').strip().splitlines()
+        if not paths or not os.path.exists(paths[-1]):
+            raise JobError(f"no file downloaded (over {settings['max_filesize']}?)")
+
+        filename = f"youtube-{os.path.basename(paths[-1])}"
+        shutil.move(paths[-1], f"{config['media']['path']}/{filename}")
+        return filename
+
+async def _worker():
+    while True:
+        video, job = await _queue.get()
+        try:
+            if not job.cancelled():
+                filename = await _run(video)
+                if not job.cancelled():
+                    job.set_result(filename)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        except Exception as e:
+            if not job.cancelled():
+                job.set_exception(e)
+        finally:
+            _queue.task_done()
+
+def start():
+    '''
+    Start the worker tasks (on first use)
+    '''
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(_settings()['workers']))
+
+def submit(video):
+    '''
+    Queues a download of youtube video, returns future of its media filename
+    '''
+    start()
+    job = asyncio.get_running_loop().create_future()
+    _queue.put_nowait((video, job))
+    return job
+
+async def close():
+    '''
+    Stop the workers, killing running downloads (called on shutdown)
+    '''
+    global _queue
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None